@@ -0,0 +1,50 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Measures how long it takes to import the driver, in fresh interpreters, and
+# what that import pulls in. Run it from this directory:
+#
+#     python bench_import.py [runs]
+
+import os
+import subprocess
+import sys
+
+stages = [
+    ('import rethinkdb', 'import rethinkdb'),
+    ('  + protobuf (first connect)', 'import rethinkdb, rethinkdb.wire; rethinkdb.wire.protobuf()')
+]
+
+child = """
+import sys, time
+start = time.time()
+%s
+elapsed = time.time() - start
+print('%%f %%d %%d' %% (elapsed, 'rethinkdb.docs' in sys.modules, 'google.protobuf' in sys.modules))
+"""
+
+def measure(code, runs, env):
+    times = [ ]
+    for i in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', child % code], env=env)
+        (elapsed, docs, protobuf) = output.decode().split()
+        times.append(float(elapsed) * 1000)
+    times.sort()
+    return (times[0], times[len(times) // 2], docs == '1', protobuf == '1')
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    # Installed packages come with bytecode, so make sure it is written
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPATH'] = os.path.dirname(os.path.abspath(__file__))
+    measure(stages[-1][1], 1, env)
+
+    print('%-30s %8s %8s  %s' % ('', 'min', 'median', 'loaded'))
+    for (name, code) in stages:
+        (fastest, median, docs, protobuf) = measure(code, runs, env)
+        loaded = [module for (module, present) in [('docs', docs), ('protobuf', protobuf)] if present]
+        print('%-30s %6.1fms %6.1fms  %s' % (name, fastest, median, ', '.join(loaded) or '-'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Generates rethinkdb/ql2.py from ql2.proto. It holds the values of the enums
+# in ql2.proto as plain class attributes, laid out the way the protobuf
+# bindings expose them, so that queries can be built without importing the
+# bindings.
+
+import re
+import sys
+
+token_re = re.compile(r'(message|enum)\s+(\w+)\s*{|(\w+)\s*=\s*(\w+)\s*;|}')
+
+def parse(text):
+    text = re.sub(r'//[^\n]*', '', text)
+    root = ('message', None, [ ], [ ])
+    stack = [root]
+    for match in token_re.finditer(text):
+        (kind, name, key, value) = match.groups()
+        if kind is not None:
+            node = (kind, name, [ ], [ ])
+            stack[-1][2].append(node)
+            stack.append(node)
+        elif key is not None:
+            # Only enums assign values; message fields assign field numbers
+            if stack[-1][0] == 'enum':
+                stack[-1][3].append((key, int(value, 0)))
+        else:
+            stack.pop()
+    return root
+
+def write_class(out, node, indent):
+    (kind, name, children, values) = node
+    out.append('%sclass %s(object):' % (indent, name))
+    inner = indent + '    '
+    body = len(out)
+    for child in children:
+        write_class(out, child, inner)
+    for (key, value) in values:
+        out.append('%s%s = %d' % (inner, key, value))
+    if kind == 'message':
+        # The values of nested enums are also attributes of the message
+        for child in children:
+            if child[0] == 'enum':
+                for (key, value) in child[3]:
+                    out.append('%s%s = %d' % (inner, key, value))
+    if len(out) == body:
+        out.append('%spass' % inner)
+
+def convert(text):
+    out = ['# Generated from ql2.proto by convert_protofile.py. Do not edit.', '']
+    for node in parse(text)[2]:
+        write_class(out, node, '')
+        out.append('')
+    return '\n'.join(out)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.stderr.write('Usage: %s ql2.proto ql2.py\n' % sys.argv[0])
+        sys.exit(1)
+    with open(sys.argv[1]) as infile:
+        text = infile.read()
+    with open(sys.argv[2], 'w') as outfile:
+        outfile.write(convert(text))
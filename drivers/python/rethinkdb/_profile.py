@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+import sys, os, json
+from optparse import OptionParser
+
+from rethinkdb.errors import RqlDriverError
+from rethinkdb import profiling
+
+info = "'rethinkdb profile' analyzes query profiles saved as JSON"
+usage = "rethinkdb profile FILE [--folded | --diff FILE] [--top NUM] [--min-percent PERCENT]"
+
+def print_profile_help():
+    print info
+    print usage
+    print ""
+    print "  FILE                             a JSON file holding the profile of a query run with"
+    print "                                   profile=True, or the whole result of the query"
+    print "                                   (- reads from standard input)"
+    print "  -h [ --help ]                    print this help"
+    print "  --folded                         print the profile as folded stacks, for flamegraph"
+    print "                                   tools"
+    print "  --diff FILE                      compare FILE, a later profile of the same query, to"
+    print "                                   the first one"
+    print "  --top NUM                        number of tasks to list by self time (defaults to 10)"
+    print "  --min-percent PERCENT            leave tasks that took less than PERCENT of the query's"
+    print "                                   time out of the summary (defaults to 0.5)"
+    print ""
+    print "EXAMPLES:"
+    print ""
+    print "rethinkdb profile slow_query.json"
+    print "  Show where the time of a query went, task by task."
+    print ""
+    print "rethinkdb profile slow_query.json --folded | flamegraph.pl > slow_query.svg"
+    print "  Draw a flame graph of a query."
+    print ""
+    print "rethinkdb profile before.json --diff after.json"
+    print "  Compare two profiles of the same query, e.g. before and after adding an index."
+
+def parse_options():
+    parser = OptionParser(add_help_option=False, usage=usage)
+    parser.add_option("--folded", dest="folded", action="store_true", default=False)
+    parser.add_option("--diff", dest="diff", metavar="FILE", default=None, type="string")
+    parser.add_option("--top", dest="top", metavar="NUM", default=10, type="int")
+    parser.add_option("--min-percent", dest="min_percent", metavar="PERCENT", default=0.5, type="float")
+    parser.add_option("-h", "--help", dest="help", default=False, action="store_true")
+    (options, args) = parser.parse_args()
+
+    if options.help:
+        print_profile_help()
+        exit(0)
+
+    # Check validity of arguments
+    if len(args) == 0:
+        raise RuntimeError("Error: Profile to analyze not specified.")
+    elif len(args) != 1:
+        raise RuntimeError("Error: Only one positional argument supported")
+
+    if options.folded and options.diff is not None:
+        raise RuntimeError("Error: --folded and --diff cannot be used together")
+    if options.top < 0:
+        raise RuntimeError("Error: invalid number of tasks (%d)" % options.top)
+
+    res = { }
+    res["file"] = args[0]
+    res["folded"] = options.folded
+    res["diff"] = options.diff
+    res["top"] = options.top
+    res["min_percent"] = options.min_percent
+    return res
+
+def load_profile(filename):
+    try:
+        if filename == "-":
+            data = json.load(sys.stdin)
+        else:
+            with open(filename, "r") as f:
+                data = json.load(f)
+        return profiling.analyze(data)
+    except (IOError, ValueError, RqlDriverError) as ex:
+        raise RuntimeError("Error: Could not read profile from %s: %s" % (filename, ex))
+
+def write(text):
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    sys.stdout.write(text)
+
+def print_report(tree, options):
+    write(profiling.flame_summary(tree, min_percent=options["min_percent"]) + "\n")
+
+    write("\n%10s %12s %12s  %s\n" % ("count", "self", "total", "task"))
+    for row in profiling.by_term(tree)[:options["top"]]:
+        write("%10d %10.3fms %10.3fms  %s\n" % (row["count"], row["self_time"], row["total"], row["description"]))
+
+    splits = profiling.parallel_tasks(tree)
+    if len(splits) > 0:
+        write("\n%10s %12s %12s %12s %12s  %s\n" % ("branches", "wall", "work", "slowest", "imbalance", "split under"))
+        for split in splits:
+            write("%10d %10.3fms %10.3fms %10.3fms %12.2f  %s\n" %
+                  (split["branches"], split["wall"], split["work"], split["max"], split["imbalance"],
+                   " > ".join(split["path"][1:]) or "Query"))
+
+def run_profile(options):
+    tree = load_profile(options["file"])
+    if options["folded"]:
+        write(profiling.folded_stacks(tree))
+    elif options["diff"] is not None:
+        write(profiling.format_diff(tree, load_profile(options["diff"])) + "\n")
+    else:
+        print_report(tree, options)
+
+def main():
+    try:
+        options = parse_options()
+    except RuntimeError as ex:
+        print >> sys.stderr, "Usage: %s" % usage
+        print >> sys.stderr, ex
+        return 1
+
+    try:
+        run_profile(options)
+    except RuntimeError as ex:
+        print >> sys.stderr, ex
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -1,12 +1,14 @@
-from . import ql2_pb2 as p
+from . import ql2 as p
 import types
 import sys
 import datetime
+import calendar
 import numbers
 import collections
 import time
 import re
 import json as py_json
+import math
 from threading import Lock
 from .errors import *
 from . import repl # For the repl connection
@@ -20,55 +22,136 @@ def expr(val, nesting_depth=20):
     if nesting_depth <= 0:
         raise RqlDriverError("Nesting depth limit exceeded")
 
+    convert = _expr_types.get(type(val))
+    if convert is not None:
+        return convert(val, nesting_depth)
+
     if isinstance(val, RqlQuery):
+        # Remember the query class, as it is sure to come up again
+        _expr_types[type(val)] = _expr_query
         return val
+    elif isinstance(val, list) or isinstance(val, dict):
+        return _expr_data(val, nesting_depth)
     elif isinstance(val, datetime.datetime) or isinstance(val, datetime.date):
-        if not hasattr(val, 'tzinfo') or not val.tzinfo:
-            raise RqlDriverError("""Cannot convert %s to ReQL time object
-            without timezone information. You can add timezone information with
-            the third party module \"pytz\" or by constructing ReQL compatible
-            timezone values with r.make_timezone(\"[+-]HH:MM\"). Alternatively,
-            use one of ReQL's bultin time constructors, r.now, r.time, or r.iso8601.
-            """ % (type(val).__name__))
-        return ISO8601(val.isoformat())
-    elif isinstance(val, list):
-        val = [expr(v, nesting_depth - 1) for v in val]
-        return MakeArray(*val)
-    elif isinstance(val, dict):
-        # MakeObj doesn't take the dict as a keyword args to avoid
-        # conflicting with the `self` parameter.
-        obj = {}
-        for k in val.keys():
-            obj[k] = expr(val[k], nesting_depth - 1)
-        return MakeObj(obj)
+        return _expr_time(val, nesting_depth)
     elif isinstance(val, collections.Callable):
         return Func(val)
     else:
         return Datum(val)
 
-# Like expr but attempts to serialize as much of the value as JSON
-# as possible.
-def exprJSON(val, nesting_depth=20):
+def _expr_query(val, nesting_depth):
+    return val
+
+def _expr_datum(val, nesting_depth):
+    return Datum(val)
+
+def _expr_data(val, nesting_depth):
+    # Plain data is sent as a single JSON value instead of a term per
+    # element; only the parts of it that hold queries become terms.
+    val = _convert_data(val, nesting_depth)
+    if isinstance(val, RqlQuery):
+        return val
+    return JsonData(val)
+
+def _expr_time(val, nesting_depth):
+    if not hasattr(val, 'tzinfo') or not val.tzinfo:
+        raise RqlDriverError("""Cannot convert %s to ReQL time object
+        without timezone information. You can add timezone information with
+        the third party module \"pytz\" or by constructing ReQL compatible
+        timezone values with r.make_timezone(\"[+-]HH:MM\"). Alternatively,
+        use one of ReQL's bultin time constructors, r.now, r.time, or r.iso8601.
+        """ % (type(val).__name__))
+    return ISO8601(val.isoformat())
+
+def _expr_func(val, nesting_depth):
+    return Func(val)
+
+# How `expr` converts values of the most common types, by exact type
+_expr_types = {
+    types.NoneType: _expr_datum,
+    bool: _expr_datum,
+    int: _expr_datum,
+    long: _expr_datum,
+    float: _expr_datum,
+    str: _expr_datum,
+    unicode: _expr_datum,
+    list: _expr_data,
+    dict: _expr_data,
+    datetime.datetime: _expr_time,
+    datetime.date: _expr_time,
+    types.FunctionType: _expr_func,
+    types.MethodType: _expr_func
+}
+
+# Converts a value in a single pass. Values that are plain JSON data are
+# returned as they are; anything else is returned as the term it converts to,
+# with the plain data inside it collapsed into JSON. Nothing is copied until a
+# query turns up.
+_data_types = frozenset([types.NoneType, bool, int, long, str, unicode])
+
+def _convert_data(val, nesting_depth):
     if nesting_depth <= 0:
         raise RqlDriverError("Nesting depth limit exceeded")
 
-    if isinstance(val, RqlQuery):
+    val_type = type(val)
+    if val_type in _data_types:
+        return val
+
+    if val_type is list:
+        for (i, v) in enumerate(val):
+            term = _convert_data(v, nesting_depth - 1)
+            if isinstance(term, RqlQuery):
+                items = [_data_term(v) for v in val[:i]]
+                items.append(term)
+                items.extend([_data_term(_convert_data(v, nesting_depth - 1)) for v in val[i + 1:]])
+                return MakeArray(*items)
+        return val
+    elif val_type is dict:
+        obj = None
+        for (k, v) in val.iteritems():
+            if not isinstance(k, types.StringTypes):
+                raise RqlDriverError("Object keys must be strings.")
+            term = _convert_data(v, nesting_depth - 1)
+            if obj is not None:
+                obj[k] = _data_term(term)
+            elif isinstance(term, RqlQuery):
+                obj = { }
+                for (done_k, done_v) in val.iteritems():
+                    if done_k == k:
+                        break
+                    obj[done_k] = _data_term(done_v)
+                obj[k] = term
+        if obj is None:
+            return val
+        return MakeObj(obj)
+    elif isinstance(val, float):
+        if math.isinf(val) or math.isnan(val):
+            # Not representable in JSON
+            return Datum(val)
         return val
-    elif isJSON(val, nesting_depth):
-        return Json(py_json.dumps(val))
-    elif isinstance(val, dict):
-        copy = val.copy()
-        for k,v in copy.items():
-            copy[k] = exprJSON(v, nesting_depth)
-        return MakeObj(copy)
     elif isinstance(val, list):
-        copy = []
-        for v in val:
-            copy.append(exprJSON(v, nesting_depth))
-        return MakeArray(*copy)
+        return _convert_data(list(val), nesting_depth)
+    elif isinstance(val, dict):
+        return _convert_data(dict(val), nesting_depth)
+    elif isinstance(val, (int, long, types.StringTypes)):
+        return val
+    elif isinstance(val, datetime.datetime) and val.utcoffset() is not None:
+        # Written as a TIME pseudo-type object by `_json_default`
+        return val
     else:
-        # Default to datum serialization
-        return expr(val, nesting_depth - 1)
+        return expr(val, nesting_depth)
+
+def _data_term(val):
+    if isinstance(val, RqlQuery):
+        return val
+    elif isinstance(val, (list, dict, datetime.datetime)):
+        # Datetimes are written as TIME pseudo-type objects
+        return JsonData(val)
+    return Datum(val)
+
+# Kept for compatibility: `expr` now serializes plain data as JSON itself
+def exprJSON(val, nesting_depth=20):
+    return expr(val, nesting_depth)
 
 def isJSON(val, nesting_depth=20):
     if nesting_depth <= 0:
@@ -85,17 +168,48 @@ def isJSON(val, nesting_depth=20):
     else:
         return False
 
+def _has_implicit_var(args, optargs):
+    for arg in args:
+        if arg.has_implicit_var:
+            return True
+    for arg in optargs.itervalues():
+        if arg.has_implicit_var:
+            return True
+    return False
+
+# Query nodes have no instance dictionary: every subclass gets an empty
+# `__slots__` unless it lists the attributes it needs itself.
+class _RqlQueryType(type):
+    def __new__(mcs, name, bases, attrs):
+        attrs.setdefault('__slots__', ())
+        return type.__new__(mcs, name, bases, attrs)
+
+# Shared by all the nodes without arguments. They must never be modified.
+_no_args = ()
+_no_optargs = {}
+
 class RqlQuery(object):
+    __metaclass__ = _RqlQueryType
+
+    # `has_implicit_var` tells whether `r.row` appears anywhere in this query.
+    # It is worked out as the query is built, so `func_wrap` never has to scan
+    # the query itself.
+    __slots__ = ('args', 'optargs', 'has_implicit_var')
 
     # Instantiate this AST node with the given pos and opt args
     def __init__(self, *args, **optargs):
-        self.args = [expr(e) for e in args]
+        self.args = [expr(e) for e in args] if args else _no_args
+
+        if optargs:
+            self.optargs = {}
+            for k in optargs.keys():
+                if not isinstance(optargs[k], RqlQuery) and optargs[k] == ():
+                    continue
+                self.optargs[k] = expr(optargs[k])
+        else:
+            self.optargs = _no_optargs
 
-        self.optargs = {}
-        for k in optargs.keys():
-            if not isinstance(optargs[k], RqlQuery) and optargs[k] == ():
-                continue
-            self.optargs[k] = expr(optargs[k])
+        self.has_implicit_var = _has_implicit_var(self.args, self.optargs)
 
     # Send this query to the server to be executed
     def run(self, c=None, **global_opt_args):
@@ -486,9 +600,11 @@ class RqlQuery(object):
 # These classes define how nodes are printed by overloading `compose`
 
 def needs_wrap(arg):
-    return isinstance(arg, Datum) or isinstance(arg, MakeArray) or isinstance(arg, MakeObj)
+    return isinstance(arg, Datum) or isinstance(arg, MakeArray) or isinstance(arg, MakeObj) or isinstance(arg, JsonData)
 
 class RqlBoolOperQuery(RqlQuery):
+    __slots__ = ('infix',)
+
     def __init__(self, *args, **optargs):
         if 'infix' in optargs:
             self.infix = optargs['infix']
@@ -547,6 +663,9 @@ class RqlTzinfo(datetime.tzinfo):
 
     def __init__(self, offsetstr):
         hours, minutes = map(int, offsetstr.split(':'))
+        if offsetstr.startswith('-'):
+            # The minutes of a negative offset are negative too
+            minutes = -minutes
 
         self.offsetstr = offsetstr
         self.delta = datetime.timedelta(hours=hours, minutes=minutes)
@@ -566,15 +685,54 @@ class RqlTzinfo(datetime.tzinfo):
     def dst(self, dt):
         return datetime.timedelta(0)
 
+# Every TIME value in a result set usually shares one of a handful of
+# offsets, so the tzinfo objects are cached per offset string
+_tzinfo_cache = { }
+
+def _tzinfo(offsetstr):
+    tzinfo = _tzinfo_cache.get(offsetstr)
+    if tzinfo is None:
+        tzinfo = _tzinfo_cache.setdefault(offsetstr, RqlTzinfo(offsetstr))
+    return tzinfo
+
 def reql_type_time_to_datetime(obj):
     if not 'epoch_time' in obj:
         raise RqlDriverError('pseudo-type TIME object %s does not have expected field "epoch_time".' % py_json.dumps(obj))
 
     if 'timezone' in obj:
-        return datetime.datetime.fromtimestamp(obj['epoch_time'], RqlTzinfo(obj['timezone']))
+        return datetime.datetime.fromtimestamp(obj['epoch_time'], _tzinfo(obj['timezone']))
     else:
         return datetime.datetime.utcfromtimestamp(obj['epoch_time'])
 
+# The function used to parse R_JSON datums. It is called as
+# `loads(text, object_hook=hook)`; decoders that do not support object hooks
+# can be set with `object_hook=False`, in which case pseudo-types are
+# converted in a second pass over the result.
+_json_loads = py_json.loads
+_json_object_hook = True
+
+def set_json_decoder(loads=None, object_hook=True):
+    '''
+        Use a different JSON decoder (e.g. `simplejson.loads`) for query
+        results. Pass no arguments to go back to the standard library one.
+    '''
+    global _json_loads, _json_object_hook
+    if loads is None:
+        loads, object_hook = py_json.loads, True
+    _json_loads = loads
+    _json_object_hook = object_hook
+
+# The reverse of `reql_type_time_to_datetime`, for timezone-aware datetimes
+def datetime_to_reql_type_time(dt):
+    offset = dt.utcoffset()
+    offset_minutes = offset.days * 24 * 60 + offset.seconds // 60
+    sign = '-' if offset_minutes < 0 else '+'
+    (hours, minutes) = divmod(abs(offset_minutes), 60)
+
+    return {'$reql_type$': 'TIME',
+            'epoch_time': calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1000000.0,
+            'timezone': '%s%02d:%02d' % (sign, hours, minutes)}
+
 # This class handles the conversion of RQL terminal types in both directions
 # Going to the server though it does not support R_ARRAY or R_OBJECT as those
 # are alternately handled by the MakeArray and MakeObject nodes. Why do this?
@@ -583,10 +741,12 @@ def reql_type_time_to_datetime(obj):
 # R_ARRAYs and R_OBJECTs would require verifying that at all nested levels
 # our arrays and objects are composed only of basic types.
 class Datum(RqlQuery):
-    args = []
-    optargs = {}
+    __slots__ = ('data',)
 
     def __init__(self, val):
+        self.args = _no_args
+        self.optargs = _no_optargs
+        self.has_implicit_var = False
         self.data = val
 
     def build(self, term):
@@ -635,12 +795,53 @@ class Datum(RqlQuery):
                 obj[i] = Datum._recursively_convert_pseudotypes(obj[i], time_format)
         return obj
 
+    # Object hooks that convert pseudo-types while the JSON is being parsed,
+    # one per time format
+    _object_hooks = { }
+
+    @staticmethod
+    def _object_hook(time_format):
+        hook = Datum._object_hooks.get(time_format)
+        if hook is None:
+            convert = Datum._convert_pseudotype
+            def hook(obj):
+                if '$reql_type$' in obj:
+                    return convert(obj, time_format)
+                return obj
+            Datum._object_hooks[time_format] = hook
+        return hook
+
+    @staticmethod
+    def _loads(text, time_format):
+        if _json_object_hook:
+            return _json_loads(text, object_hook=Datum._object_hook(time_format))
+        return Datum._recursively_convert_pseudotypes(_json_loads(text), time_format)
+
+    # Decodes a whole batch of datums. When they are all JSON, as they are
+    # whenever the server honors `accepts_r_json`, they are parsed together
+    # with a single call to the JSON decoder.
+    @staticmethod
+    def deconstruct_batch(datums, time_format='native'):
+        for datum in datums:
+            if datum.type != p.Datum.R_JSON:
+                return [Datum.deconstruct(d, time_format) for d in datums]
+
+        return Datum._loads('[' + ','.join([datum.r_str for datum in datums]) + ']', time_format)
+
+    # Returns the JSON text of a datum. R_JSON datums are passed through as
+    # the server sent them; anything else is encoded compactly, leaving
+    # pseudo-types as they are.
+    @staticmethod
+    def to_json(datum):
+        if datum.type == p.Datum.R_JSON:
+            return datum.r_str
+        return py_json.dumps(Datum.deconstruct(datum, 'raw'), separators=(',', ':'))
+
     @staticmethod
     def deconstruct(datum, time_format='native'):
         d_type = datum.type
         if d_type == p.Datum.R_JSON:
-            obj = py_json.loads(datum.r_str)
-            return Datum._recursively_convert_pseudotypes(obj, time_format)
+            return Datum._loads(datum.r_str, time_format)
         elif d_type == p.Datum.R_OBJECT:
             obj = { }
             for pair in datum.r_object:
@@ -650,8 +851,7 @@ class Datum(RqlQuery):
             # be an object or something else. We need a second layer of type switching, this
             # time on an obfuscated field "$reql_type$" rather than the datum type field we
             # already switched on.
-            Datum._convert_pseudotype(obj, time_format)
-            return obj
+            return Datum._convert_pseudotype(obj, time_format)
         elif d_type == p.Datum.R_ARRAY:
             array = datum.r_array
             return [Datum.deconstruct(e, time_format) for e in array]
@@ -690,7 +890,7 @@ class MakeObj(RqlQuery):
     # the `self` parameter. This is not a problem for other RqlQuery sub-
     # classes unless we add a 'self' optional argument to one of them.
     def __init__(self, obj_dict):
-        self.args = []
+        self.args = _no_args
 
         self.optargs = {}
         for k in obj_dict.keys():
@@ -698,6 +898,8 @@ class MakeObj(RqlQuery):
                 raise RqlDriverError("Object keys must be strings.");
             self.optargs[k] = expr(obj_dict[k])
 
+        self.has_implicit_var = _has_implicit_var(self.args, self.optargs)
+
     def compose(self, args, optargs):
         return T('{', T(*[T(repr(name), ': ', optargs[name]) for name in optargs.keys()], intsp=', '), '}')
 
@@ -720,8 +922,15 @@ class Default(RqlMethodQuery):
     st = "default"
 
 class ImplicitVar(RqlQuery):
+    # `r.row` is a single shared instance with a docstring of its own
+    __slots__ = ('__dict__',)
     tt = p.Term.IMPLICIT_VAR
 
+    def __init__(self):
+        self.args = _no_args
+        self.optargs = _no_optargs
+        self.has_implicit_var = True
+
     def compose(self, args, optargs):
         return 'r.row'
 
@@ -894,7 +1103,7 @@ class Table(RqlQuery):
     st = 'table'
 
     def insert(self, records, upsert=(), durability=(), return_vals=()):
-        return Insert(self, exprJSON(records), upsert=upsert,
+        return Insert(self, expr(records), upsert=upsert,
                       durability=durability, return_vals=return_vals)
 
     def get(self, key):
@@ -1149,6 +1358,34 @@ class Json(RqlTopLevelQuery):
     tt = p.Term.JSON
     st = 'json'
 
+# Plain data sent as a single JSON string. It prints as the value it was made
+# from, the same way the equivalent `MakeArray` and `MakeObj` terms would.
+class JsonData(Json):
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+        self.args = [Datum(py_json.dumps(data, default=_json_default))]
+        self.optargs = _no_optargs
+        self.has_implicit_var = False
+
+    def compose(self, args, optargs):
+        return _compose_data(self.data)
+
+def _json_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return datetime_to_reql_type_time(obj)
+    raise TypeError("%s is not JSON serializable" % repr(obj))
+
+def _compose_data(data):
+    if isinstance(data, datetime.datetime):
+        return T('r.iso8601(', repr(data.isoformat()), ')')
+    elif isinstance(data, list):
+        return T('[', T(*[_compose_data(v) for v in data], intsp=', '), ']')
+    elif isinstance(data, dict):
+        return T('{', T(*[T(repr(k), ': ', _compose_data(v)) for (k, v) in data.items()], intsp=', '), '}')
+    return repr(data)
+
 class ToISO8601(RqlMethodQuery):
     tt = p.Term.TO_ISO8601
     st = 'to_iso8601'
@@ -1229,25 +1466,14 @@ class ToEpochTime(RqlMethodQuery):
 def func_wrap(val):
     val = expr(val)
 
-    # Scan for IMPLICIT_VAR or JS
-    def ivar_scan(node):
-        if not isinstance(node, RqlQuery):
-            return False
-
-        if isinstance(node, ImplicitVar):
-            return True
-        if any([ivar_scan(arg) for arg in node.args]):
-            return True
-        if any([ivar_scan(arg) for k,arg in node.optargs.items()]):
-            return True
-        return False
-
-    if ivar_scan(val):
+    # Queries using IMPLICIT_VAR are wrapped in a function
+    if val.has_implicit_var:
         return Func(lambda x: val)
 
     return val
 
 class Func(RqlQuery):
+    __slots__ = ('vrs',)
     tt = p.Term.FUNC
     lock = Lock()
     nextVarId = 1
@@ -1265,11 +1491,28 @@ class Func(RqlQuery):
 
         self.vrs = vrs
         self.args = [MakeArray(*vrids), expr(lmbd(*vrs))]
-        self.optargs = {}
+        self.optargs = _no_optargs
+        self.has_implicit_var = self.args[1].has_implicit_var
 
     def compose(self, args, optargs):
             return T('lambda ', T(*[v.compose([v.args[0].compose(None, None)], []) for v in self.vrs], intsp=', '), ': ', args[1])
 
+# A placeholder for a value that is only given when a prepared query is run
+class Param(RqlQuery):
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.args = _no_args
+        self.optargs = _no_optargs
+        self.has_implicit_var = False
+        self.name = name
+
+    def build(self, term):
+        raise RqlDriverError("r.param(%s) can only be used in a query passed to r.prepare." % repr(self.name))
+
+    def compose(self, args, optargs):
+        return 'r.param(%s)' % repr(self.name)
+
 class Asc(RqlTopLevelQuery):
     tt = p.Term.ASC
     st = 'asc'
@@ -0,0 +1,261 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Buffers documents and writes them in batches, as multi-document inserts:
+#
+#     with r.BulkWriter(pool, r.table('events'), max_docs=1000) as writer:
+#         for event in events:
+#             writer.add(event)
+#
+# A batch is sent once it holds `max_docs` documents or `max_bytes` bytes of
+# JSON, and, if `flush_interval` is given, at the latest that many seconds
+# after its first document was added. With `upsert=True` a document replaces
+# any buffered document with the same primary key, so only the last version
+# is sent.
+#
+# With `noreply=True` batches are sent without waiting for the server; every
+# `sync_every` batches, and on `flush()` and `close()`, `noreply_wait()` makes
+# sure they have all been written. Write errors are then not reported. In the
+# default mode the errors of every batch are counted, and `flush()` and
+# `close()` raise an `RqlDriverError` with the first of them.
+#
+# Documents are serialized to JSON as they are added; documents containing
+# queries (e.g. `r.now()`) are sent as they are.
+
+__all__ = ['BulkWriter']
+
+import collections
+import json as py_json
+import threading
+import time
+
+from rethinkdb.errors import *
+from rethinkdb.ast import Table, Json, _json_default, expr
+from rethinkdb.net import ConnectionPool
+from rethinkdb.loader import _hashable
+
+class BulkWriter(object):
+    def __init__(self, conn, table, max_docs=1000, max_bytes=1024 * 1024, flush_interval=None,
+                 upsert=False, primary_key='id', durability=(), noreply=False, sync_every=10):
+        if max_docs < 1:
+            raise RqlDriverError("Invalid batch size: max_docs=%s." % max_docs)
+        if not isinstance(table, Table):
+            raise RqlDriverError("BulkWriter must be given a table.")
+
+        self.conn = conn
+        self.table = table
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.upsert = upsert
+        self.primary_key = primary_key
+        self.durability = durability
+        self.noreply = noreply
+        self.sync_every = sync_every
+
+        self.lock = threading.Condition(threading.Lock())
+        self.send_lock = threading.Lock() # Held while a batch is sent
+        self.buffer = collections.OrderedDict() # Key -> (document, JSON or None, size)
+        self.buffered_bytes = 0
+        self.first_added = None
+        self.next_seq = 0
+        self.closed = False
+
+        self.held = None   # Pooled connection kept until the next noreply_wait
+        self.unsynced = 0  # Batches sent with noreply since the last noreply_wait
+        self.errors = 0
+        self.first_error = None
+        self.counters = {'added': 0, 'merged': 0, 'batches': 0, 'inserted': 0,
+                         'replaced': 0, 'unchanged': 0, 'errors': 0}
+
+        self.flusher = None
+        if flush_interval is not None:
+            self.flusher = threading.Thread(target=self._flush_loop)
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def add(self, doc):
+        try:
+            text = py_json.dumps(doc, default=_json_default, allow_nan=False)
+            size = len(text) + 1
+        except (TypeError, ValueError):
+            text = None
+            size = len(repr(doc)) + 1
+
+        with self.lock:
+            if self.closed:
+                raise RqlDriverError("BulkWriter is closed.")
+            self.counters['added'] += 1
+
+            key = None
+            if self.upsert and isinstance(doc, dict) and self.primary_key in doc:
+                key = ('key', _hashable(doc[self.primary_key]))
+                old = self.buffer.get(key)
+                if old is not None:
+                    self.counters['merged'] += 1
+                    self.buffered_bytes -= old[2]
+            if key is None:
+                key = ('seq', self.next_seq)
+                self.next_seq += 1
+
+            self.buffer[key] = (doc, text, size)
+            self.buffered_bytes += size
+            if self.first_added is None:
+                self.first_added = time.time()
+                self.lock.notify()
+
+            full = len(self.buffer) >= self.max_docs or \
+                   (self.max_bytes is not None and self.buffered_bytes >= self.max_bytes)
+
+        if full:
+            self._send_buffer()
+
+    def add_many(self, docs):
+        for doc in docs:
+            self.add(doc)
+
+    # Writes out everything buffered so far, waits until it has been written
+    # and raises the first error since the last call, if there was one
+    def flush(self):
+        self._send_buffer()
+        with self.send_lock:
+            self._sync()
+        self._raise_errors()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.lock.notify()
+        flusher, self.flusher = self.flusher, None
+        if flusher is not None and flusher is not threading.current_thread():
+            flusher.join()
+        try:
+            self.flush()
+        finally:
+            self._release()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['buffered'] = len(self.buffer)
+            stats['buffered_bytes'] = self.buffered_bytes
+            return stats
+
+    # Takes the buffered documents out as a batch. Must hold the lock.
+    def _take(self):
+        if len(self.buffer) == 0:
+            return None
+        batch = self.buffer.values()
+        self.buffer = collections.OrderedDict()
+        self.buffered_bytes = 0
+        self.first_added = None
+        return batch
+
+    def _flush_loop(self):
+        while True:
+            with self.lock:
+                while not self.closed:
+                    if self.first_added is None:
+                        self.lock.wait()
+                        continue
+                    remaining = self.first_added + self.flush_interval - time.time()
+                    if remaining <= 0:
+                        break
+                    self.lock.wait(remaining)
+                if self.closed:
+                    return
+            self._send_buffer()
+
+    # Sends whatever is buffered. Batches are taken out under the send lock,
+    # so that they are sent in the order they were filled.
+    def _send_buffer(self):
+        with self.send_lock:
+            with self.lock:
+                batch = self._take()
+            if batch is not None:
+                self._send_locked(batch)
+
+    def _send_locked(self, batch):
+        texts = [text for (doc, text, size) in batch if text is not None]
+        others = [doc for (doc, text, size) in batch if text is None]
+        if len(texts) == 0:
+            docs = expr(others)
+        else:
+            docs = Json('[' + ','.join(texts) + ']')
+            if len(others) > 0:
+                docs = docs.union(others)
+
+        query = self.table.insert(docs, upsert=self.upsert or (), durability=self.durability)
+        try:
+            if self.noreply:
+                query.run(self._noreply_conn(), noreply=True)
+                self.unsynced += 1
+                if self.sync_every is not None and self.unsynced >= self.sync_every:
+                    self._sync()
+            elif isinstance(self.conn, ConnectionPool):
+                with self.conn.connection() as conn:
+                    result = query.run(conn)
+                self._count(result, len(batch))
+            else:
+                self._count(query.run(self.conn), len(batch))
+        except Exception as err:
+            self._error(len(batch), err)
+        finally:
+            with self.lock:
+                self.counters['batches'] += 1
+
+    def _count(self, result, docs):
+        with self.lock:
+            for field in ('inserted', 'replaced', 'unchanged'):
+                self.counters[field] += result.get(field, 0)
+        if result.get('errors', 0) > 0:
+            self._error(result['errors'], result.get('first_error'))
+
+    def _error(self, count, error):
+        with self.lock:
+            self.counters['errors'] += count
+            self.errors += count
+            if self.first_error is None:
+                self.first_error = error
+
+    # The connection noreply batches are sent on. A pooled connection is kept
+    # until they have been waited for, since that only works on the same one.
+    def _noreply_conn(self):
+        if not isinstance(self.conn, ConnectionPool):
+            return self.conn
+        if self.held is None:
+            self.held = self.conn.acquire()
+        return self.held
+
+    # Waits for the batches sent with noreply. Must hold the send lock.
+    def _sync(self):
+        if self.unsynced == 0:
+            return
+        try:
+            self._noreply_conn().noreply_wait()
+        except Exception as err:
+            self._error(0, err)
+        self.unsynced = 0
+        self._release()
+
+    def _release(self):
+        held, self.held = self.held, None
+        if held is not None:
+            self.conn.release(held)
+
+    def _raise_errors(self):
+        with self.lock:
+            errors, self.errors = self.errors, 0
+            first_error, self.first_error = self.first_error, None
+        if errors == 0 and first_error is not None:
+            # Only waiting for the noreply batches failed
+            raise first_error
+        if errors > 0:
+            raise RqlDriverError("%d documents could not be written. First error: %s" % (errors, first_error))
@@ -0,0 +1,340 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# An opt-in cache of read results, shared by the connections it is given to
+# (every connection of a pool shares the pool's). Only queries run with the
+# `cache=True` run option are answered from it:
+#
+#     cache = r.ResultCache(max_entries=1000, ttl=60, max_bytes=1024 * 1024)
+#     conn = r.connect(cache=cache)
+#     r.table('config').get('flags').run(conn, cache=True)
+#
+# Results are keyed on the serialized query and its global optargs, so only
+# identical queries share an entry. The least recently used entries are
+# evicted once there are more than `max_entries` of them or their responses
+# take more than `max_bytes`, and entries expire `ttl` seconds after being
+# stored. Writes run on a connection using the cache drop the entries of
+# every table they touch, but writes by other clients are not seen: `ttl`
+# bounds how stale a result can get. Queries whose result may change from one
+# run to the next (`r.now()`, `r.js`, `sample`) are refused.
+
+__all__ = ['ResultCache']
+
+import collections
+import functools
+import threading
+import time
+
+from rethinkdb import ql2 as p
+
+from rethinkdb.errors import *
+from rethinkdb.ast import Datum
+from rethinkdb.prepared import BoundQuery
+
+# Terms that change the documents of the tables in the query
+_write_terms = frozenset([p.Term.INSERT, p.Term.UPDATE, p.Term.REPLACE, p.Term.DELETE])
+
+# Terms that change databases, tables or indexes, which may affect any entry
+_schema_terms = frozenset([p.Term.DB_CREATE, p.Term.DB_DROP, p.Term.TABLE_CREATE,
+                           p.Term.TABLE_DROP, p.Term.INDEX_CREATE, p.Term.INDEX_DROP])
+
+_uncacheable_terms = {
+    p.Term.NOW: 'r.now()',
+    p.Term.JAVASCRIPT: 'r.js',
+    p.Term.SAMPLE: 'sample'
+}
+
+# Returns the names of the tables a query uses (None if some of them are only
+# known to the server), whether it writes to them, and why it cannot be
+# cached, if it cannot
+def _scan(term):
+    if isinstance(term, BoundQuery):
+        term = term.prepared.query
+
+    tables = set()
+    writes = False
+    reason = None
+    stack = [term]
+    while len(stack) > 0:
+        node = stack.pop()
+        tt = getattr(node, 'tt', None)
+        if tt == p.Term.TABLE:
+            name = node.args[-1]
+            if tables is not None and isinstance(name, Datum) and isinstance(name.data, basestring):
+                tables.add(name.data)
+            else:
+                tables = None
+        elif tt in _write_terms:
+            writes = True
+        elif tt in _schema_terms:
+            writes = True
+            tables = None
+        elif tt in _uncacheable_terms and reason is None:
+            reason = _uncacheable_terms[tt]
+        stack.extend(node.args)
+        stack.extend(node.optargs.values())
+    return (tables, writes, reason)
+
+class _Entry(object):
+    __slots__ = ('response', 'tables', 'size', 'expires')
+
+    def __init__(self, response, tables, size, expires):
+        self.response = response
+        self.tables = tables
+        self.size = size
+        self.expires = expires
+
+class ResultCache(object):
+    def __init__(self, max_entries=1024, ttl=None, max_bytes=None):
+        if max_entries < 1:
+            raise RqlDriverError("Invalid cache size: max_entries=%s." % max_entries)
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # Least recently used first
+        self.size = 0
+        self.by_table = { }  # Table name -> keys of the entries that read it
+        self.unscoped = set() # Keys of the entries that read unknown tables
+
+        # A read is only stored if nothing it depends on was written to while
+        # it was running. Writes to unknown tables count against every table.
+        self.generations = { } # Table name -> writes to it
+        self.resets = 0
+        self.writes = 0
+
+        self.counters = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0,
+                         'expirations': 0, 'invalidations': 0, 'uncacheable': 0}
+
+    # Drops the entries that read any of the given tables, or every entry if
+    # none are given
+    def invalidate(self, *tables):
+        self._invalidate(set(tables) if len(tables) > 0 else None)
+
+    def clear(self):
+        with self.lock:
+            self._remove_all()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.size
+            return stats
+
+    # Drops what the given queries write to before and after `run` is called.
+    # They are not answered from the cache.
+    def _run_writes(self, terms, run):
+        writes = False
+        tables = set()
+        for term in terms:
+            (term_tables, term_writes, reason) = _scan(term)
+            if term_writes:
+                writes = True
+                tables = None if tables is None or term_tables is None else tables | term_tables
+        if not writes:
+            return run()
+
+        self._invalidate(tables)
+        try:
+            return run()
+        finally:
+            self._invalidate(tables)
+
+    # Runs a START query on the connection, through the cache
+    def _run(self, conn, query, term, opts):
+        (tables, writes, reason) = _scan(term)
+        if writes:
+            # Reads started while the write runs must not be stored either
+            self._invalidate(tables)
+            try:
+                return conn._send_start(query, term, opts)
+            finally:
+                self._invalidate(tables)
+
+        if not opts.get('cache', False) or opts.get('noreply', False):
+            return conn._send_start(query, term, opts)
+        if reason is not None:
+            with self.lock:
+                self.counters['uncacheable'] += 1
+            raise RqlDriverError("Cannot cache a query that uses %s." % reason)
+
+        key = (query.body(), opts.get('result_format', 'native'))
+        response = self._lookup(key)
+        if response is not None:
+            return conn._response_value(query, response, term, opts)
+
+        pending = (key, tables, self._generation(tables))
+        query.observers += (functools.partial(self._store, pending),)
+        return conn._send_start(query, term, opts)
+
+    def _generation(self, tables):
+        with self.lock:
+            return self._generation_locked(tables)
+
+    def _lookup(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry.expires is not None and entry.expires <= time.time():
+                self.counters['expirations'] += 1
+                self._forget(key, entry)
+                entry = None
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+
+            # Moves the entry to the most recently used end
+            self.entries[key] = entry
+            self.counters['hits'] += 1
+            return entry.response
+
+    # Stores the response to a read started through `_run`, unless it is only
+    # part of a sequence or something it read has been written to since
+    def _store(self, pending, response):
+        (key, tables, generation) = pending
+        if response.type != p.Response.SUCCESS_ATOM and response.type != p.Response.SUCCESS_SEQUENCE:
+            return
+
+        size = len(key[0]) + response.ByteSize()
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+
+        with self.lock:
+            if self._generation_locked(tables) != generation:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self._forget(key, old)
+
+            self.entries[key] = _Entry(response, tables, size, expires)
+            self.size += size
+            if tables is None:
+                self.unscoped.add(key)
+            else:
+                for name in tables:
+                    self.by_table.setdefault(name, set()).add(key)
+            self.counters['stores'] += 1
+
+            while len(self.entries) > self.max_entries or \
+                  (self.max_bytes is not None and self.size > self.max_bytes):
+                (old_key, old) = self.entries.popitem(last=False)
+                self._forget(old_key, old)
+                self.counters['evictions'] += 1
+
+    def _invalidate(self, tables):
+        with self.lock:
+            self.writes += 1
+            self.counters['invalidations'] += 1
+            if tables is None:
+                self.resets += 1
+                self._remove_all()
+                return
+
+            for name in tables:
+                self.generations[name] = self.generations.get(name, 0) + 1
+                for key in self.by_table.pop(name, ()):
+                    self._remove(key)
+            for key in list(self.unscoped):
+                self._remove(key)
+
+    # The following must be called with the lock held
+
+    def _generation_locked(self, tables):
+        if tables is None:
+            return (self.writes,)
+        return (self.resets, [self.generations.get(name, 0) for name in sorted(tables)])
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self._forget(key, entry)
+
+    # Drops the bookkeeping of an entry already taken out of `entries`
+    def _forget(self, key, entry):
+        self.size -= entry.size
+        if entry.tables is None:
+            self.unscoped.discard(key)
+        else:
+            for name in entry.tables:
+                keys = self.by_table.get(name)
+                if keys is not None:
+                    keys.discard(key)
+                    if len(keys) == 0:
+                        del self.by_table[name]
+
+    def _remove_all(self):
+        self.entries.clear()
+        self.by_table.clear()
+        self.unscoped.clear()
+        self.size = 0
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+
+# Single-flight deduplication of reads, for connections shared between threads
+# (multiplexed connections and pools). While a read is in flight, identical
+# reads (same serialized query and global optargs) wait for its response
+# instead of being sent, and each caller decodes the shared response into a
+# value of its own. A read answered with a partial sequence cannot be shared,
+# since the cursor belongs to one caller, so the others send their own.
+class _SingleFlight(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = { }
+        self.counters = {'led': 0, 'deduplicated': 0}
+
+    def _run(self, conn, query, term, opts):
+        if opts.get('noreply', False):
+            return conn._send_query(query, term, opts)
+        (tables, writes, reason) = _scan(term)
+        if writes or reason is not None:
+            return conn._send_query(query, term, opts)
+
+        key = (query.body(), opts.get('result_format', 'native'))
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = _Flight()
+                self.counters['led'] += 1
+                leader = True
+            else:
+                self.counters['deduplicated'] += 1
+                leader = False
+
+        if leader:
+            query.observers += (functools.partial(self._land, key, flight),)
+            try:
+                return conn._send_query(query, term, opts)
+            finally:
+                # Without a response the others have to send their own
+                if not flight.done.is_set():
+                    self._land(key, flight, None)
+
+        # A deadline of the caller's own holds while it waits on the leader;
+        # it has sent nothing, so there is nothing to stop
+        deadline = opts.get('deadline')
+        if deadline is None:
+            flight.done.wait()
+        elif not flight.done.wait(max(deadline - time.time(), 0)):
+            raise RqlTimeoutError("Query timed out.")
+        response = flight.response
+        if response is None or response.type == p.Response.SUCCESS_PARTIAL:
+            return conn._send_query(query, term, opts)
+        return conn._response_value(query, response, term, opts)
+
+    def _land(self, key, flight, response):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        flight.response = response
+        flight.done.set()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
@@ -0,0 +1,154 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Builds columns out of the rows of a cursor, batch by batch, for
+# `Cursor.to_columns`. Each column becomes a NumPy array when NumPy is
+# installed, or an `array.array` otherwise (a plain list for columns that
+# are neither booleans nor numbers).
+
+__all__ = ['Columns', 'ColumnBuilder']
+
+import array
+import numbers
+
+from rethinkdb.errors import RqlDriverError
+
+# Python 2 has no 'q' typecode, and 'l' is only 64 bits wide on LP64
+# platforms (not on Windows); where neither is, integers are kept in a list
+_int_typecode = None
+for _typecode in ('q', 'l'):
+    try:
+        if array.array(_typecode).itemsize == 8:
+            _int_typecode = _typecode
+            break
+    except ValueError:
+        pass
+
+_typecodes = {'bool': 'b', 'int': _int_typecode, 'float': 'd'}
+_fillers = {'bool': False, 'int': 0, 'float': float('nan'), 'object': None}
+
+# A dict of field name to column. `nulls` maps each field name to a mask that
+# is true for the rows where the field was null or missing.
+class Columns(dict):
+    def __init__(self):
+        dict.__init__(self)
+        self.nulls = { }
+
+class ColumnBuilder(object):
+    def __init__(self, fields=None):
+        self.fixed = fields is not None
+        self.fields = list(fields or [])
+        self.columns = dict((field, _Column(0)) for field in self.fields)
+        self.count = 0
+
+    def add_batch(self, rows):
+        columns = self.columns
+        for row in rows:
+            if not isinstance(row, dict):
+                raise RqlDriverError("Cannot build columns from a sequence of %s." % type(row).__name__)
+
+            if not self.fixed:
+                for field in row:
+                    if field not in columns:
+                        # A field first seen now was missing from the earlier rows
+                        self.fields.append(field)
+                        columns[field] = _Column(self.count)
+
+            for field in self.fields:
+                columns[field].append(row.get(field))
+            self.count += 1
+
+    def build(self):
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        columns = Columns()
+        for field in self.fields:
+            (columns[field], columns.nulls[field]) = self.columns[field].build(numpy)
+        return columns
+
+def _value_kind(value):
+    if isinstance(value, bool):
+        return 'bool'
+    elif isinstance(value, numbers.Integral):
+        return 'int'
+    elif isinstance(value, numbers.Real):
+        return 'float'
+    return 'object'
+
+# The kind of a column holding values of both kinds: integers and floats make
+# floats, anything else mixed makes objects
+def _merge_kinds(kind, value_kind):
+    if kind is None or kind == value_kind:
+        return value_kind
+    if kind in ('int', 'float') and value_kind in ('int', 'float'):
+        return 'float'
+    return 'object'
+
+# A column filled in as the rows arrive, in an `array.array` as long as its
+# values are all booleans or all numbers. The column is converted when a value
+# of another kind turns up, which happens at most twice.
+class _Column(object):
+    def __init__(self, count):
+        self.kind = None # Until the first value that is not null
+        self.values = None
+        self.nulls = array.array('b', [1]) * count
+
+    def append(self, value):
+        if value is None:
+            self.nulls.append(1)
+            if self.values is not None:
+                self.values.append(_fillers[self.kind])
+            return
+
+        kind = _merge_kinds(self.kind, _value_kind(value))
+        if kind != self.kind:
+            self._convert(kind)
+        try:
+            self.values.append(value)
+        except OverflowError:
+            # An integer too large for 64 bits
+            self._convert('object')
+            self.values.append(value)
+        self.nulls.append(0)
+
+    def _convert(self, kind):
+        if self.values is None:
+            values = [None] * len(self.nulls)
+        else:
+            values = [None if null else value for (value, null) in zip(self.values, self.nulls)]
+            if self.kind == 'bool':
+                # Stored as bytes
+                values = [None if value is None else bool(value) for value in values]
+        self.kind = kind
+        self.values = None # Let the old column go before the new one is built
+
+        typecode = _typecodes.get(kind)
+        if typecode is None:
+            self.values = [_fillers[kind] if value is None else value for value in values]
+        else:
+            self.values = array.array(typecode, [_fillers[kind] if value is None else value for value in values])
+
+    def build(self, numpy):
+        kind = self.kind or 'object'
+        values = self.values
+        if values is None:
+            values = [None] * len(self.nulls)
+
+        if numpy is None:
+            return (values, self.nulls)
+
+        nulls = _numpy_column(numpy, self.nulls, numpy.bool_)
+        if kind == 'object':
+            column = numpy.empty(len(values), dtype=object)
+            column[:] = values
+            return (column, nulls)
+        dtype = {'bool': numpy.bool_, 'int': numpy.int64, 'float': numpy.float64}[kind]
+        return (_numpy_column(numpy, values, dtype), nulls)
+
+# Wraps an `array.array` without copying it
+def _numpy_column(numpy, values, dtype):
+    if isinstance(values, list) or len(values) == 0:
+        return numpy.array(values, dtype=dtype)
+    return numpy.frombuffer(values, dtype=dtype)
@@ -1,4 +1,4 @@
-from . import ql2_pb2 as p
+from . import ql2 as p
 
 class RqlError(Exception):
     def __init__(self, message, term, frames):
@@ -29,6 +29,11 @@ class RqlDriverError(Exception):
     def __str__(self):
         return self.message
 
+# Raised when a query run with the `timeout` or `deadline` run option has not
+# been answered in time
+class RqlTimeoutError(RqlDriverError):
+    pass
+
 class QueryPrinter(object):
     def __init__(self, root, frames=[]):
         self.root = root
@@ -0,0 +1,148 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Batches point lookups. Threads that load keys of the same table within
+# `window` seconds of each other (or until `max_batch` keys have been asked
+# for) share a single `get_all` query, and each gets back the documents for
+# its own keys:
+#
+#     users = r.GetLoader(pool, r.table('users'))
+#     users.load(1)                    # the document, or None if missing
+#
+#     by_email = r.GetLoader(pool, r.table('users'), index='email')
+#     by_email.load('a@example.com')   # a list of the matching documents
+#
+# The first thread to ask for a key waits for the window to pass and then
+# runs the query for everyone, so the loader only pays off when many threads
+# look keys up at once; it must be given a pool or a multiplexed connection.
+# Documents are matched back to keys by their primary key field or by the
+# field the index is named after; for indexes built some other way, `key`
+# gives the index value of a document. Threads loading the same key in the
+# same batch get the same document back.
+
+__all__ = ['GetLoader']
+
+import numbers
+import threading
+
+from rethinkdb.errors import *
+from rethinkdb.ast import Table
+from rethinkdb.net import ConnectionPool
+
+# Keys are looked up in dicts, so arrays (compound keys) become tuples. In
+# Python True == 1, but not for the server, so booleans and numbers are told
+# apart. Numbers are all doubles for the server, so 1 and 1.0 are the same key.
+def _hashable(key):
+    if isinstance(key, list):
+        return tuple(_hashable(item) for item in key)
+    elif isinstance(key, bool):
+        return (bool, key)
+    elif isinstance(key, numbers.Real):
+        return (float, key)
+    return key
+
+class _Batch(object):
+    def __init__(self):
+        self.keys = [ ]
+        self.seen = set()
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+class GetLoader(object):
+    def __init__(self, conn, table, index=None, primary_key='id', key=None,
+                 window=0.005, max_batch=100):
+        if max_batch < 1:
+            raise RqlDriverError("Invalid batch size: max_batch=%s." % max_batch)
+        if not isinstance(table, Table):
+            raise RqlDriverError("GetLoader must be given a table.")
+
+        self.conn = conn
+        self.table = table
+        self.index = index
+        self.window = window
+        self.max_batch = max_batch
+        if key is None:
+            field = primary_key if index is None else index
+            key = lambda doc: doc.get(field)
+        self.key = key
+
+        self.lock = threading.Lock()
+        self.batch = None
+        self.counters = {'loads': 0, 'keys': 0, 'batches': 0}
+
+    def load(self, key):
+        return self.load_many([key])[0]
+
+    def load_many(self, keys):
+        # Keys are checked before joining a batch, so that a bad one cannot
+        # leave a batch behind that is never sent
+        hashables = [_hashable(key) for key in keys]
+        for (key, hashable) in zip(keys, hashables):
+            try:
+                hash(hashable)
+            except TypeError:
+                raise RqlDriverError("Cannot load %r: keys must be strings, numbers, booleans or arrays." % (key,))
+
+        with self.lock:
+            self.counters['loads'] += 1
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = _Batch()
+            for (key, hashable) in zip(keys, hashables):
+                if hashable not in batch.seen:
+                    batch.seen.add(hashable)
+                    batch.keys.append(key)
+            if len(batch.keys) >= self.max_batch:
+                # Later keys go to the next batch
+                self.batch = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self.lock:
+                if self.batch is batch:
+                    self.batch = None
+            self._fetch(batch)
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        missing = None if self.index is None else [ ]
+        return [batch.results.get(hashable, missing) for hashable in hashables]
+
+    def _fetch(self, batch):
+        options = { }
+        if self.index is not None:
+            options['index'] = self.index
+        try:
+            query = self.table.get_all(*batch.keys, **options)
+            if isinstance(self.conn, ConnectionPool):
+                with self.conn.connection() as conn:
+                    docs = list(query.run(conn))
+            else:
+                docs = list(query.run(self.conn))
+
+            results = { }
+            for doc in docs:
+                key = _hashable(self.key(doc))
+                if self.index is None:
+                    results[key] = doc
+                else:
+                    results.setdefault(key, [ ]).append(doc)
+            batch.results = results
+        except Exception as err:
+            batch.error = err
+        finally:
+            if batch.results is None and batch.error is None:
+                batch.error = RqlDriverError("The batch was interrupted.")
+            with self.lock:
+                self.counters['batches'] += 1
+                self.counters['keys'] += len(batch.keys)
+            batch.done.set()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
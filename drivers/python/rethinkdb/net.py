@@ -1,24 +1,52 @@
 # Copyright 2010-2012 RethinkDB, all rights reserved.
 
-__all__ = ['connect', 'Connection', 'Cursor', 'protobuf_implementation']
+__all__ = ['connect', 'Connection', 'ConnectionPool', 'Cursor', 'MultiplexedConnection', 'protobuf_implementation']
 
 import errno
+import imp
+import os
+import Queue
 import socket
 import struct
+import threading
+import time
 from os import environ
 
+# The C++ protobuf backend is loaded along with the protobuf bindings, on
+# first use (see `wire.protobuf`). google.protobuf picks its backend when it
+# is first imported though, maybe by the application in the meantime, so it
+# is asked for right away.
 try:
-    import rethinkdb.pbcpp
-    protobuf_implementation = 'cpp'
+    imp.find_module('_pbcpp', [os.path.dirname(__file__)])
+    environ['PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION'] = 'cpp'
 except ImportError:
-    protobuf_implementation = 'python'
+    pass
 
-from rethinkdb import ql2_pb2 as p
+from rethinkdb import ql2 as p
 
 from rethinkdb import repl # For the repl connection
 from rethinkdb.errors import *
 from rethinkdb.ast import Datum, DB, expr
-
+from rethinkdb.wire import StartQuery, decode_envelope, protobuf, protobuf_implementation
+from rethinkdb.cache import _SingleFlight
+from rethinkdb.stats import QueryEvent
+
+# Run options that only affect the driver and are not sent to the server
+_driver_opts = ('prefetch', 'max_buffered_bytes', 'decode_ahead', 'result_format', 'cache',
+                'timeout', 'deadline')
+_result_formats = ('native', 'raw_json')
+
+# Cursors accept the following run options:
+#  - `prefetch`: how many batches to keep buffered or requested ahead of the
+#    one being consumed (default 1).
+#  - `max_buffered_bytes`: stop requesting batches ahead while the cursor holds
+#    at least this many bytes of responses (default unlimited).
+#  - `decode_ahead`: decode buffered batches in a background thread while the
+#    caller is still working through the current one. This only pays off when
+#    the caller spends its time outside the interpreter lock (e.g. in I/O).
+#  - `result_format`: 'raw_json' yields the JSON text of each row instead of
+#    decoding it, for callers that only write the results back out.
+# `buffered_bytes` gives the size of the responses the cursor currently holds.
 class Cursor(object):
     def __init__(self, conn, query, term, opts):
         self.conn = conn
@@ -28,52 +56,226 @@ class Cursor(object):
         self.responses = [ ]
         self.outstanding_requests = 0
         self.end_flag = False
+        self.buffered_bytes = 0
+        self.decoding = { }
 
         self.time_format = 'native'
         if 'time_format' in self.opts:
             self.time_format = self.opts['time_format']
 
+        self.prefetch = self.opts.get('prefetch', 1)
+        self.max_buffered_bytes = self.opts.get('max_buffered_bytes', None)
+        self.result_format = self.opts.get('result_format', 'native')
+        self.decode_ahead = self.opts.get('decode_ahead', False) and self.result_format != 'raw_json'
+
     def _extend(self, response):
+        if self.end_flag:
+            # This answers a CONTINUE that was sent ahead before the end of the
+            # stream was known, or was outstanding when the cursor was closed
+            return
+
         self.end_flag = response.type != p.Response.SUCCESS_PARTIAL
         self.responses.append(response)
+        self.buffered_bytes += response.ByteSize()
+
+        if self.decode_ahead and len(self.responses) > 1 and \
+           (response.type == p.Response.SUCCESS_PARTIAL or response.type == p.Response.SUCCESS_SEQUENCE):
+            self.decoding[id(response)] = _decode_in_background(response, self.time_format)
+
+        self._fetch_ahead()
 
-        if len(self.responses) == 1 and not self.end_flag:
+    # Requests more batches until `prefetch` of them are buffered or in flight
+    # behind the one being consumed, or the memory cap is reached
+    def _fetch_ahead(self):
+        while not self.end_flag and len(self.responses) + self.outstanding_requests <= self.prefetch:
+            if self.max_buffered_bytes is not None and self.buffered_bytes >= self.max_buffered_bytes:
+                break
             self.conn._async_continue_cursor(self)
 
+    def _pop_response(self):
+        response = self.responses.pop(0)
+        self.buffered_bytes -= response.ByteSize()
+        return response
+
+    # Waits until the batch at the front of the cursor has arrived and checks
+    # it for errors, without consuming it. Returns None at the end of the stream.
+    def _peek_response(self):
+        if len(self.responses) == 0 and not self.end_flag:
+            self.conn._continue_cursor(self)
+        self._fetch_ahead()
+
+        if len(self.responses) == 0 and self.end_flag:
+            return None
+
+        response = self.responses[0]
+        self.conn._check_error_response(response, self.term)
+        if response.type != p.Response.SUCCESS_PARTIAL and response.type != p.Response.SUCCESS_SEQUENCE:
+            raise RqlDriverError("Unexpected response type received for cursor")
+        return response
+
+    def _decode_response(self, response):
+        decoding = self.decoding.pop(id(response), None)
+        if decoding is not None:
+            return decoding.result()
+        if self.result_format == 'raw_json':
+            return [Datum.to_json(datum) for datum in response.response]
+        return Datum.deconstruct_batch(response.response, self.time_format)
+
     def __iter__(self):
         time_format = self.time_format
         deconstruct = Datum.deconstruct
+        raw_json = self.result_format == 'raw_json'
         while True:
-            if len(self.responses) == 0 and not self.end_flag:
-                self.conn._continue_cursor(self)
-            if len(self.responses) == 1 and not self.end_flag:
-                self.conn._async_continue_cursor(self)
-
-            if len(self.responses) == 0 and self.end_flag:
+            response = self._peek_response()
+            if response is None:
                 break
 
-            self.conn._check_error_response(self.responses[0], self.term)
-            if self.responses[0].type != p.Response.SUCCESS_PARTIAL and self.responses[0].type != p.Response.SUCCESS_SEQUENCE:
-                raise RqlDriverError("Unexpected response type received for cursor")
+            decoding = self.decoding.pop(id(response), None)
+            if decoding is not None:
+                for row in decoding.result():
+                    yield row
+            elif raw_json:
+                for datum in response.response:
+                    yield Datum.to_json(datum)
+            else:
+                for datum in response.response:
+                    yield deconstruct(datum, time_format)
+            self._pop_response()
+
+    # Returns the rows of the next batch sent by the server as a list, decoded
+    # in one pass, or None once the cursor is exhausted. Mixing this with row
+    # by row iteration of the same cursor is not supported.
+    def next_batch(self):
+        while True:
+            response = self._peek_response()
+            if response is None:
+                return None
+
+            rows = self._decode_response(response)
+            self._pop_response()
+            if len(rows) > 0:
+                return rows
 
-            for datum in self.responses[0].response:
-                yield deconstruct(datum, time_format)
-            del self.responses[0]
+    def iter_batches(self):
+        while True:
+            rows = self.next_batch()
+            if rows is None:
+                break
+            yield rows
+
+    # Reads the rest of the cursor into a dict of field name to column (a
+    # NumPy array when NumPy is available, an `array.array` otherwise). The
+    # result's `nulls` attribute maps each field to a mask of the rows where
+    # it was null or missing. Columns are filled batch by batch, so the rows
+    # are never all held as dicts at once. Only the given fields are
+    # collected; pluck them in the query to keep the rest off the wire.
+    def to_columns(self, fields=None):
+        from rethinkdb.columns import ColumnBuilder
+
+        builder = ColumnBuilder(fields)
+        for rows in self.iter_batches():
+            builder.add_batch(rows)
+        return builder.build()
 
     def close(self):
         if not self.end_flag:
             self.end_flag = True
             self.conn._end_cursor(self)
 
+class _DecodedBatch(object):
+    def __init__(self, response, time_format):
+        self.response = response
+        self.time_format = time_format
+        self.rows = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.rows = Datum.deconstruct_batch(self.response.response, self.time_format)
+        except Exception as err:
+            self.error = err
+        self.done.set()
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.rows
+
+# A single daemon thread decodes batches for all cursors using `decode_ahead`
+_decode_queue = None
+_decode_lock = threading.Lock()
+
+def _decode_loop(queue):
+    while True:
+        queue.get().run()
+
+def _decode_in_background(response, time_format):
+    global _decode_queue
+    with _decode_lock:
+        if _decode_queue is None:
+            _decode_queue = Queue.Queue()
+            thread = threading.Thread(target=_decode_loop, args=(_decode_queue,))
+            thread.daemon = True
+            thread.start()
+    batch = _DecodedBatch(response, time_format)
+    _decode_queue.put(batch)
+    return batch
+
+_query_types = dict((value, name) for (name, value) in vars(p.Query.QueryType).items()
+                    if not name.startswith('_'))
+
+# Turns the `timeout` run option into a `deadline`, keeping the earlier one
+# if both are given
+def _fix_deadline(opts):
+    if opts.get('timeout') is not None:
+        deadline = time.time() + opts['timeout']
+        if opts.get('deadline') is not None:
+            deadline = min(deadline, opts['deadline'])
+        opts['deadline'] = deadline
+
+def _new_counters():
+    return {'bytes_out': 0, 'bytes_in': 0, 'queries': dict((name, 0) for name in _query_types.values()),
+            'rtt': None, 'min_rtt': None}
+
+# Queries run with the `timeout` (in seconds) or `deadline` (a `time.time()`
+# value) run option raise an `RqlTimeoutError` when their response, or a
+# batch of their cursor, has not arrived in time. The server is then asked to
+# stop the query and whatever it still sends for it is dropped, so the
+# connection can go on being used. The server evaluates the queries of a
+# connection one at a time and cannot interrupt one that is running, though:
+# later queries on the same connection wait until it is done. Pools close
+# their connections that still have such a query running instead of reusing
+# them, which does interrupt it.
+#
+# A connection may be given a `ResultCache` (see cache.py): reads run with the
+# `cache=True` run option are then answered from it when possible, and writes
+# drop what they may have changed from it. Connections shared between threads
+# may also deduplicate identical reads in flight (see `_SingleFlight`).
+#
+# Observers added with `add_observer` are called with a `QueryEvent` (see
+# stats.py) for every query started with `run()`, and `stats()` gives the
+# traffic of the connection so far.
 class Connection(object):
-    def __init__(self, host, port, db, auth_key, timeout):
+    _cursor_class = Cursor
+    cache = None
+    single_flight = None
+    observers = ()
+
+    def __init__(self, host, port, db, auth_key, timeout, cache=None, single_flight=None):
         self.socket = None
         self.host = host
         self.next_token = 1
         self.db = db
         self.auth_key = auth_key
         self.timeout = timeout
+        self.cache = cache
+        self.single_flight = single_flight
         self.cursor_cache = { }
+        self.abandoned = { } # Token -> responses still to come for a query that is over
+        self.timed_out = set() # Tokens in `abandoned` of queries that timed out
+        self.counters = _new_counters()
 
         # Try to convert the port to an integer
         try:
@@ -100,22 +302,26 @@ class Connection(object):
         except Exception as err:
             raise RqlDriverError("Could not connect to %s:%s. Error: %s" % (self.host, self.port, err))
 
-        self._sock_sendall(struct.pack("<L", p.VersionDummy.V0_2))
-        self._sock_sendall(struct.pack("<L", len(self.auth_key)) + str.encode(self.auth_key, 'ascii'))
+        self._sock_sendall(_handshake(self.auth_key))
 
-        # Read out the response from the server, which will be a null-terminated string
+        # Read out the response from the server, which will be a null-terminated
+        # string. The server sends nothing else until it receives a query, so
+        # it is safe to read it in chunks rather than a byte at a time.
         response = b""
-        while True:
-            char = self._sock_recv(1)
-            if char == b"\0":
-                break
-            response += char
+        while not response.endswith(b"\0"):
+            chunk = self._sock_recv(64)
+            if len(chunk) == 0:
+                self.close(noreply_wait=False)
+                raise RqlDriverError("Connection is closed.")
+            response += chunk
+        response = response[:-1]
 
         if response != b"SUCCESS":
             self.close(noreply_wait=False)
             raise RqlDriverError("Server dropped connection with message: \"%s\"" % response.strip())
 
         # Connection is now initialized
+        self.recv_buffer = _ResponseBuffer()
 
         # Clear timeout so we don't timeout on long running queries
         self.socket.settimeout(None)
@@ -131,19 +337,43 @@ class Connection(object):
             self.socket.close()
             self.socket = None
         self.cursor_cache = { }
+        self.abandoned = { }
+        self.timed_out = set()
 
     def noreply_wait(self):
-        token = self.next_token
-        self.next_token += 1
+        token = self._new_token()
 
         # Construct query
-        query = p.Query()
+        query = protobuf().Query()
         query.type = p.Query.NOREPLY_WAIT
         query.token = token
 
         # Send the request
         return self._send_query(query, 'noreply_wait')
 
+    # Observers are kept in a tuple that is replaced rather than changed, so
+    # that queries running in other threads can go through it unlocked
+    def add_observer(self, observer):
+        self.observers = self.observers + (observer,)
+
+    def remove_observer(self, observer):
+        self.observers = tuple(item for item in self.observers if item is not observer)
+
+    # Bytes sent and received (including the framing of each message), the
+    # number of queries sent by type, the responses awaited and the cursors
+    # open, and a smoothed estimate of the round trip time in seconds (along
+    # with the lowest one seen), which includes the time the server spends
+    # on each query
+    def stats(self):
+        stats = dict(self.counters)
+        stats['queries'] = dict(stats['queries'])
+        stats['open_cursors'] = len(self.cursor_cache)
+        stats['in_flight'] = self._in_flight()
+        return stats
+
+    def _in_flight(self):
+        return sum([cursor.outstanding_requests for cursor in self.cursor_cache.values()])
+
     # Not thread safe. Sets this connection as global state that will be used
     # by subsequence calls to `query.run`. Useful for trying out RethinkDB in
     # a Python repl environment.
@@ -159,6 +389,14 @@ class Connection(object):
                 if e.errno != errno.EINTR:
                     raise
 
+    def _sock_recv_into(self, view):
+        while True:
+            try:
+                return self.socket.recv_into(view)
+            except IOError as e:
+                if e.errno != errno.EINTR:
+                    raise
+
     def _sock_sendall(self, data):
         while True:
             try:
@@ -167,14 +405,132 @@ class Connection(object):
                 if e.errno != errno.EINTR:
                     raise
 
+    # Sends all of the given queries in a single write before reading any of
+    # the responses, so a batch of queries costs one round trip instead of one
+    # each. Returns the results in the order the queries were given. If any of
+    # the queries fails, the first error is raised once every response has
+    # been read.
+    def run_many(self, queries, **global_opt_args):
+        # A single deadline for the whole batch
+        _fix_deadline(global_opt_args)
+        deadline = global_opt_args.get('deadline')
+
+        batch = [ ]
+        for term in queries:
+            term = expr(term)
+            opts = dict(global_opt_args)
+            batch.append((self._start_query(term, opts), term, opts))
+
+        noreply = 'noreply' in global_opt_args and global_opt_args['noreply']
+        send = lambda: self._send_batch([query for (query, term, opts) in batch], noreply, deadline)
+        if self.cache is not None:
+            responses = self.cache._run_writes([term for (query, term, opts) in batch], send)
+        else:
+            responses = send()
+        if noreply:
+            return [None for entry in batch]
+
+        results = [ ]
+        error = None
+        for (query, term, opts) in batch:
+            try:
+                results.append(self._response_value(query, responses[query.token], term, opts))
+            except RqlError as err:
+                results.append(None)
+                error = error or err
+        if error is not None:
+            raise error
+        return results
+
+    # Sends the queries in a single write and returns their responses by token.
+    # The queries still unanswered at the deadline are abandoned.
+    def _send_batch(self, queries, noreply, deadline=None):
+        # Error if this connection has closed
+        if not self.socket:
+            raise RqlDriverError("Connection is closed.")
+
+        self._send_frames(queries)
+
+        if noreply:
+            return None
+
+        # The server may answer the queries in any order
+        responses = { }
+        for query in queries:
+            responses[query.token] = None
+        pending = len(queries)
+        while pending > 0:
+            try:
+                response = self._read_frame(deadline)
+            except RqlTimeoutError:
+                for (token, answer) in responses.items():
+                    if answer is None:
+                        self._abandon(token, 1)
+                raise
+            if responses.get(response.token, ()) is None:
+                responses[response.token] = response
+                pending -= 1
+            elif response.token in self.cursor_cache:
+                self._handle_cursor_response(response)
+            elif response.token in self.abandoned:
+                self._drop_abandoned(response)
+            else:
+                # This response is corrupted or not intended for us.
+                raise RqlDriverError("Unexpected response received.")
+        return responses
+
     def _start(self, term, **global_opt_args):
+        if len(self.observers) > 0:
+            return self._start_traced(term, global_opt_args)
+        query = self._start_query(term, global_opt_args)
+        return self._run_start(query, term, global_opt_args)
+
+    def _run_start(self, query, term, opts):
+        if self.cache is not None:
+            return self.cache._run(self, query, term, opts)
+        return self._send_start(query, term, opts)
+
+    # Runs a query on behalf of `_start`, timing its phases for the observers
+    def _start_traced(self, term, opts):
+        event = QueryEvent(term)
+        try:
+            query = self._start_query(term, opts, event)
+            value = self._run_start(query, term, opts)
+        except Exception as err:
+            event.error = err
+            self._notify(event)
+            raise
+        self._decoded(event, value, opts)
+        self._notify(event)
+        return value
+
+    def _decoded(self, event, value, opts):
+        event._stamp('decode')
+        if opts.get('profile', False) and isinstance(value, dict) and 'profile' in value:
+            event.profile = value['profile']
+
+    def _notify(self, event):
+        for observer in self.observers:
+            observer(event)
+
+    def _send_start(self, query, term, opts):
+        if self.single_flight is not None:
+            return self.single_flight._run(self, query, term, opts)
+        return self._send_query(query, term, opts)
+
+    def _new_token(self):
         token = self.next_token
         self.next_token += 1
+        return token
 
-        # Construct query
-        query = p.Query()
-        query.type = p.Query.START
-        query.token = token
+    def _start_query(self, term, global_opt_args, event=None):
+        token = self._new_token()
+
+        if global_opt_args.get('result_format', 'native') not in _result_formats:
+            raise RqlDriverError("Unknown result_format run option \"%s\"." % global_opt_args['result_format'])
+
+        # The deadline applies to the cursor as well, so it is fixed here
+        _fix_deadline(global_opt_args)
 
         # Set global opt args
 
@@ -186,79 +542,184 @@ class Connection(object):
             if self.db:
                global_opt_args['db'] = DB(self.db)
 
+        optargs = { }
         for k,v in global_opt_args.items():
-            pair = query.global_optargs.add()
-            pair.key = k
-            expr(v).build(pair.val)
+            if k in _driver_opts:
+                continue
+            optargs[k] = expr(v)
 
-        # Compile query to protobuf
-        term.build(query.query)
-        return self._send_query(query, term, global_opt_args)
+        if event is None:
+            # Serialize the query straight to the wire format
+            return StartQuery(token, term, optargs)
+
+        event._stamp('build')
+        query = StartQuery(token, term, optargs)
+        query.event = event
+        event.token = token
+        event._stamp('serialize')
+        return query
 
     def _handle_cursor_response(self, response):
         cursor = self.cursor_cache[response.token]
-        cursor._extend(response)
         cursor.outstanding_requests -= 1
+        cursor._extend(response)
 
-        if response.type != p.Response.SUCCESS_PARTIAL and cursor.outstanding_requests == 0:
+        if cursor.end_flag:
             del self.cursor_cache[response.token]
+            if cursor.outstanding_requests > 0:
+                # CONTINUEs sent ahead of the end of the stream are still to
+                # be answered
+                self._drop_responses(response.token, cursor.outstanding_requests)
+                cursor.outstanding_requests = 0
 
     def _continue_cursor(self, cursor):
-        self._async_continue_cursor(cursor)
-        self._handle_cursor_response(self._read_response(cursor.query.token))
+        # A batch may already have been requested ahead of time
+        if cursor.outstanding_requests == 0:
+            self._async_continue_cursor(cursor)
+        try:
+            response = self._read_response(cursor.query.token, cursor.opts.get('deadline'))
+        except RqlTimeoutError:
+            cursor.end_flag = True
+            self._abandon(cursor.query.token, cursor.outstanding_requests)
+            raise
+        self._handle_cursor_response(response)
 
     def _async_continue_cursor(self, cursor):
         self.cursor_cache[cursor.query.token].outstanding_requests += 1
 
-        query = p.Query()
+        query = protobuf().Query()
         query.type = p.Query.CONTINUE
         query.token = cursor.query.token
         self._send_query(query, cursor.term, cursor.opts, async=True)
 
     def _end_cursor(self, cursor):
-        self.cursor_cache[cursor.query.token].outstanding_requests += 1
+        token = cursor.query.token
 
-        query = p.Query()
+        query = protobuf().Query()
         query.type = p.Query.STOP
-        query.token = cursor.query.token
-        self._send_query(cursor.query, cursor.term, async=True)
-        self._handle_cursor_response(self._read_response(cursor.query.token))
-
-    def _read_response(self, token):
+        query.token = token
+        self._send_query(query, cursor.term, async=True)
+
+        # Whatever the server still sends for this cursor is of no interest
+        self.cursor_cache.pop(token, None)
+        self._drop_responses(token, cursor.outstanding_requests + 1)
+        cursor.outstanding_requests = 0
+
+    # Gives up on a query that timed out, with `pending` responses to it still
+    # to come: the server is asked to stop it, and the responses to it and to
+    # the STOP are dropped as they arrive
+    def _abandon(self, token, pending):
+        self.cursor_cache.pop(token, None)
+        self.abandoned[token] = pending + 1
+        self.timed_out.add(token)
+
+        query = protobuf().Query()
+        query.type = p.Query.STOP
+        query.token = token
+        self._send_query(query, None, async=True)
+
+    # Drops the `pending` responses still to come for a query that is over
+    def _drop_responses(self, token, pending):
+        self.abandoned[token] = self.abandoned.get(token, 0) + pending
+
+    def _drop_abandoned(self, response):
+        token = response.token
+        self.abandoned[token] -= 1
+        if self.abandoned[token] <= 0:
+            del self.abandoned[token]
+            self.timed_out.discard(token)
+
+    # Frames the queries and sends them in a single write
+    def _send_frames(self, queries):
+        frames = [_frame_query(query) for query in queries]
+        data = b''.join(frames)
+        events = [getattr(query, 'event', None) for query in queries]
+        self._sock_sendall(data)
+
+        counters = self.counters
+        counters['bytes_out'] += len(data)
+        by_type = counters['queries']
+        for (query, frame, event) in zip(queries, frames, events):
+            name = _query_types.get(query.type)
+            by_type[name] = by_type.get(name, 0) + 1
+            if event is not None:
+                event.bytes_out = len(frame)
+                event._stamp('send')
+
+    # Records a response to a query sent at `sent`
+    def _received(self, query, response, sent):
+        rtt = time.time() - sent
+        counters = self.counters
+        if counters['rtt'] is None:
+            counters['rtt'] = rtt
+        else:
+            counters['rtt'] += (rtt - counters['rtt']) / 8
+        if counters['min_rtt'] is None or rtt < counters['min_rtt']:
+            counters['min_rtt'] = rtt
+
+        event = getattr(query, 'event', None)
+        if event is not None:
+            event._stamp('wait')
+            event.bytes_in = 4 + response.ByteSize()
+            event.response_type = response.type
+
+    # Reads the next response from the socket, whichever query it belongs to
+    def _read_frame(self, deadline=None):
+        return _parse_response(self._next_frame(deadline))
+
+    # Returns the next frame as a view into the receive buffer, which is only
+    # valid until the next read. Raises `RqlTimeoutError` if the frame has not
+    # been received by the deadline; the part of it received so far is kept.
+    def _next_frame(self, deadline=None):
+        recv_buffer = self.recv_buffer
+        try:
+            while True:
+                frame = recv_buffer.next_frame()
+                if frame is not None:
+                    break
+
+                if deadline is None:
+                    received = self._sock_recv_into(recv_buffer.free_space())
+                else:
+                    received = self._recv_until(recv_buffer.free_space(), deadline)
+                if received == 0:
+                    if recv_buffer.empty():
+                        raise RqlDriverError("Connection is closed.")
+                    raise RqlDriverError("Connection is broken.")
+                recv_buffer.received(received)
+            self.counters['bytes_in'] += 4 + len(frame)
+        except KeyboardInterrupt as err:
+            # When interrupted while waiting for a response cancel the outstanding
+            # requests by resetting this connection
+            self.reconnect()
+            raise err
+        return frame
+
+    def _recv_until(self, view, deadline):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise RqlTimeoutError("Query timed out.")
+        self.socket.settimeout(remaining)
+        try:
+            return self._sock_recv_into(view)
+        except socket.timeout:
+            raise RqlTimeoutError("Query timed out.")
+        finally:
+            if self.socket:
+                self.socket.settimeout(None)
+
+    def _read_response(self, token, deadline=None):
         # We may get an async continue result, in which case we save it and read the next response
         while True:
-            response_buf = b''
-            try:
-                response_header = b''
-                while len(response_header) < 4:
-                    chunk = self._sock_recv(4)
-                    if len(chunk) == 0:
-                        raise RqlDriverError("Connection is closed.")
-                    response_header += chunk
-
-                # The first 4 bytes give the expected length of this response
-                (response_len,) = struct.unpack("<L", response_header)
-
-                while len(response_buf) < response_len:
-                    chunk = self._sock_recv(response_len - len(response_buf))
-                    if len(chunk) == 0:
-                        raise RqlDriverError("Connection is broken.")
-                    response_buf += chunk
-            except KeyboardInterrupt as err:
-                # When interrupted while waiting for a response cancel the outstanding
-                # requests by resetting this connection
-                self.reconnect()
-                raise err
-
-            # Construct response
-            response = p.Response()
-            response.ParseFromString(response_buf)
+            response = self._read_frame(deadline)
 
             # Check that this is the response we were expecting
             if response.token == token:
                 return response
             elif response.token in self.cursor_cache:
                 self._handle_cursor_response(response)
+            elif response.token in self.abandoned:
+                self._drop_abandoned(response)
             else:
                 # This response is corrupted or not intended for us.
                 raise RqlDriverError("Unexpected response received.")
@@ -285,12 +746,8 @@ class Connection(object):
         if not self.socket:
             raise RqlDriverError("Connection is closed.")
 
-        query.accepts_r_json = True
-
         # Send protobuf
-        query_protobuf = query.SerializeToString()
-        query_header = struct.pack("<L", len(query_protobuf))
-        self._sock_sendall(query_header + query_protobuf)
+        self._send_frames([query])
 
         if 'noreply' in opts and opts['noreply']:
             return None
@@ -298,7 +755,20 @@ class Connection(object):
             return None
 
         # Get response
-        response = self._read_response(query.token)
+        sent = time.time()
+        try:
+            response = self._read_response(query.token, opts.get('deadline'))
+        except RqlTimeoutError:
+            self._abandon(query.token, 1)
+            raise
+        self._received(query, response, sent)
+        return self._response_value(query, response, term, opts)
+
+    # Converts the response to a query into the value returned to the
+    # caller, registering a cursor if the response is a sequence
+    def _response_value(self, query, response, term, opts):
+        for observer in getattr(query, 'observers', ()):
+            observer(response)
 
         self._check_error_response(response, term)
 
@@ -306,17 +776,22 @@ class Connection(object):
         if 'time_format' in opts:
             time_format = opts['time_format']
 
-        # Sequence responses
+        # Sequence responses. Only cursors that expect more responses need to
+        # be found by token.
         if response.type == p.Response.SUCCESS_PARTIAL or response.type == p.Response.SUCCESS_SEQUENCE:
-            value = Cursor(self, query, term, opts)
-            self.cursor_cache[query.token] = value
+            value = self._cursor_class(self, query, term, opts)
+            if response.type == p.Response.SUCCESS_PARTIAL:
+                self.cursor_cache[query.token] = value
             value._extend(response)
 
         # Atom response
         elif response.type == p.Response.SUCCESS_ATOM:
             if len(response.response) < 1:
                 value = None
-            value = Datum.deconstruct(response.response[0], time_format)
+            elif opts.get('result_format') == 'raw_json':
+                value = Datum.to_json(response.response[0])
+            else:
+                value = Datum.deconstruct(response.response[0], time_format)
 
         # Noreply_wait response
         elif response.type == p.Response.WAIT_COMPLETE:
@@ -335,5 +810,585 @@ class Connection(object):
             # response.profile does not exist
             return value
 
-def connect(host='localhost', port=28015, db=None, auth_key="", timeout=20):
-    return Connection(host, port, db, auth_key, timeout)
+class _ResponseWaiter(object):
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.pending = 0    # Responses expected from the server but not yet read off the socket
+        self.done = False   # Set once the caller has stopped reading responses for this token
+
+# A connection that can be shared between threads. A dedicated reader thread
+# owns the socket: it reads the token of every response and hands the rest of
+# it, unparsed, to the thread waiting on that token, while writes to the socket
+# are serialized by a lock. Responses nobody waits for are never parsed. Each
+# thread may run its own queries and iterate its own cursors, but a single
+# cursor must still only be consumed by one thread at a time.
+class MultiplexedConnection(Connection):
+    def __init__(self, host, port, db, auth_key, timeout, cache=None, single_flight=None):
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.waiters = { }
+        self.reader = None
+        self.reading = False
+        Connection.__init__(self, host, port, db, auth_key, timeout, cache, single_flight)
+
+    def reconnect(self, noreply_wait=True):
+        Connection.reconnect(self, noreply_wait)
+
+        self.reading = True
+        self.reader = threading.Thread(target=self._read_loop)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def close(self, noreply_wait=True):
+        Connection.close(self, noreply_wait)
+
+        # Shutting down the socket wakes the reader thread up
+        reader, self.reader = self.reader, None
+        if reader is not None and reader is not threading.current_thread():
+            reader.join()
+
+    def _new_token(self):
+        with self.lock:
+            return Connection._new_token(self)
+
+    def _send_frames(self, queries):
+        with self.send_lock:
+            return Connection._send_frames(self, queries)
+
+    def _received(self, query, response, sent):
+        with self.lock:
+            Connection._received(self, query, response, sent)
+
+    def stats(self):
+        with self.send_lock:
+            with self.lock:
+                return Connection.stats(self)
+
+    # Responses the reader thread has not handed over yet. Must hold the lock.
+    def _in_flight(self):
+        return sum([waiter.pending for waiter in self.waiters.values()])
+
+    def _read_loop(self):
+        try:
+            while True:
+                frame = self._next_frame()
+                (response_type, token) = decode_envelope(frame)
+                with self.lock:
+                    waiter = self.waiters.get(token)
+                    if waiter is None:
+                        # Nobody is waiting for this token, so drop the response
+                        continue
+                    waiter.pending -= 1
+                    if waiter.done:
+                        if waiter.pending <= 0:
+                            del self.waiters[token]
+                        continue
+                waiter.queue.put(frame.tobytes())
+        except Exception:
+            pass
+
+        # The connection is closed or broken: wake up every waiting thread
+        with self.lock:
+            self.reading = False
+            waiters, self.waiters = self.waiters, { }
+        for waiter in waiters.values():
+            waiter.queue.put(RqlDriverError("Connection is closed."))
+
+    # Registers that a response is expected for this token. This must happen
+    # before the query is sent, since the reader thread may see the response
+    # before the sending thread gets to wait for it.
+    def _expect(self, token):
+        with self.lock:
+            if not self.reading:
+                raise RqlDriverError("Connection is closed.")
+            waiter = self.waiters.get(token)
+            if waiter is None:
+                waiter = self.waiters[token] = _ResponseWaiter()
+            waiter.pending += 1
+
+    def _forget(self, token):
+        with self.lock:
+            waiter = self.waiters.get(token)
+            if waiter is not None:
+                waiter.done = True
+                if waiter.pending <= 0:
+                    del self.waiters[token]
+
+    def _read_response(self, token, deadline=None):
+        with self.lock:
+            waiter = self.waiters.get(token)
+        if waiter is None:
+            raise RqlDriverError("Connection is closed.")
+
+        if deadline is None:
+            frame = waiter.queue.get()
+        else:
+            try:
+                frame = waiter.queue.get(True, max(deadline - time.time(), 0))
+            except Queue.Empty:
+                raise RqlTimeoutError("Query timed out.")
+        if isinstance(frame, Exception):
+            raise frame
+        response = _parse_response(frame)
+
+        # Responses still outstanding for a finished query are discarded by
+        # the reader thread
+        if response.type != p.Response.SUCCESS_PARTIAL:
+            self._forget(token)
+        return response
+
+    def _handle_cursor_response(self, response):
+        Connection._handle_cursor_response(self, response)
+        if response.type != p.Response.SUCCESS_PARTIAL:
+            self.cursor_cache.pop(response.token, None)
+
+    def _drop_responses(self, token, pending):
+        self._forget(token)
+
+    # The reader thread keeps count of the responses still to come and drops
+    # them
+    def _abandon(self, token, pending):
+        self.cursor_cache.pop(token, None)
+
+        query = protobuf().Query()
+        query.type = p.Query.STOP
+        query.token = token
+        self._send_query(query, None, async=True)
+        self._forget(token)
+
+    def _send_batch(self, queries, noreply, deadline=None):
+        # Error if this connection has closed
+        if not self.socket:
+            raise RqlDriverError("Connection is closed.")
+
+        if not noreply:
+            for query in queries:
+                self._expect(query.token)
+
+        self._send_frames(queries)
+
+        if noreply:
+            return None
+
+        responses = { }
+        for query in queries:
+            try:
+                responses[query.token] = self._read_response(query.token, deadline)
+            except RqlTimeoutError:
+                for unanswered in queries:
+                    if unanswered.token not in responses:
+                        self._abandon(unanswered.token, 1)
+                raise
+        return responses
+
+    def _send_query(self, query, term, opts={}, async=False):
+        # Error if this connection has closed
+        if not self.socket:
+            raise RqlDriverError("Connection is closed.")
+
+        noreply = 'noreply' in opts and opts['noreply']
+        if not noreply:
+            self._expect(query.token)
+
+        # Send protobuf
+        self._send_frames([query])
+
+        if noreply or async:
+            return None
+
+        # Get response
+        sent = time.time()
+        try:
+            response = self._read_response(query.token, opts.get('deadline'))
+        except RqlTimeoutError:
+            self._abandon(query.token, 1)
+            raise
+        self._received(query, response, sent)
+        return self._response_value(query, response, term, opts)
+
+# A thread-safe pool of connections to a single server. Connections are opened
+# lazily: nothing is opened until the first checkout, which then warms the
+# pool up to `min_size` connections. At most `max_size` connections are ever
+# open; further checkouts wait up to `checkout_timeout` seconds for one to be
+# released. Idle connections beyond `min_size` are closed once they have been
+# unused for `max_idle` seconds, and a connection that has sat idle for more
+# than `probe_interval` seconds is probed with a round trip before it is handed
+# out again; one that does not answer within `probe_timeout` seconds (e.g. a
+# half-open TCP connection) is closed and replaced. A `ResultCache` given to the pool is shared by all its connections,
+# and with `single_flight` identical reads in flight on any of them are only
+# sent once. Observers added to the pool are added to all its connections.
+#
+# Pools are fork-aware: a process forked from the one that created the pool
+# (e.g. by `multiprocessing`) never uses the parent's sockets, it silently
+# starts over with connections of its own.
+#
+#     pool = r.ConnectionPool(port=28015, max_size=8)
+#     with pool.connection() as conn:
+#         r.table('users').get(1).run(conn)
+class ConnectionPool(object):
+    def __init__(self, host='localhost', port=28015, db=None, auth_key="", timeout=20,
+                 min_size=1, max_size=10, max_idle=300, checkout_timeout=None,
+                 probe_interval=30, probe_timeout=5, cache=None, single_flight=False):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise RqlDriverError("Invalid pool size: min_size=%s, max_size=%s." % (min_size, max_size))
+
+        self.host = host
+        self.port = port
+        self.db = db
+        self.auth_key = auth_key
+        self.timeout = timeout
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.checkout_timeout = checkout_timeout
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.cache = cache
+        self.single_flight = _SingleFlight() if single_flight else None
+        self.observers = ()
+        self.closed = False
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Condition(threading.Lock())
+        self.idle = [ ] # (connection, time released), most recently released last
+        self.in_use = set()
+        self.opening = 0
+        self.warmed = False
+        self.counters = {'checkouts': 0, 'waits': 0, 'wait_time': 0.0, 'timeouts': 0,
+                         'opened': 0, 'closed': 0, 'probe_failures': 0, 'forks': 0}
+
+    # Sockets inherited across a fork are shared with the parent, so they are
+    # closed here without shutting them down, which would break the parent's
+    # connections as well.
+    def _check_fork(self):
+        if self.pid == os.getpid():
+            return
+        conns = [conn for (conn, released) in self.idle] + list(self.in_use)
+        forks = self.counters['forks']
+        self._reset()
+        self.counters['forks'] = forks + 1
+        for conn in conns:
+            if conn.socket:
+                conn.socket.close()
+                conn.socket = None
+
+    def _open(self):
+        conn = Connection(self.host, self.port, self.db, self.auth_key, self.timeout,
+                          self.cache, self.single_flight)
+        conn.observers = self.observers
+        return conn
+
+    def add_observer(self, observer):
+        self._set_observers(self.observers + (observer,))
+
+    def remove_observer(self, observer):
+        self._set_observers(tuple(item for item in self.observers if item is not observer))
+
+    def _set_observers(self, observers):
+        self._check_fork()
+        with self.lock:
+            self.observers = observers
+            for conn in [conn for (conn, released) in self.idle] + list(self.in_use):
+                conn.observers = observers
+
+    def _discard(self, conn):
+        try:
+            conn.close(noreply_wait=False)
+        except Exception:
+            pass
+
+    def _is_alive(self, conn):
+        try:
+            conn.socket.settimeout(self.probe_timeout)
+            conn.noreply_wait()
+            conn.socket.settimeout(None)
+            return True
+        except Exception:
+            return False
+
+    def acquire(self, timeout=()):
+        if timeout == ():
+            timeout = self.checkout_timeout
+
+        self._check_fork()
+        with self.lock:
+            if self.closed:
+                raise RqlDriverError("Connection pool is closed.")
+            self.counters['checkouts'] += 1
+            warm = not self.warmed
+            self.warmed = True
+
+            start = time.time()
+            waited = False
+            while len(self.idle) == 0 and \
+                  len(self.in_use) + self.opening >= self.max_size:
+                remaining = None
+                if timeout is not None:
+                    remaining = timeout - (time.time() - start)
+                    if remaining <= 0:
+                        self.counters['timeouts'] += 1
+                        raise RqlDriverError("Timed out waiting for a connection from the pool.")
+                waited = True
+                self.lock.wait(remaining)
+                if self.closed:
+                    raise RqlDriverError("Connection pool is closed.")
+            if waited:
+                self.counters['waits'] += 1
+                self.counters['wait_time'] += time.time() - start
+
+            conn = None
+            if len(self.idle) > 0:
+                (conn, released) = self.idle.pop()
+            self.opening += 1
+
+        probe_failed = False
+        opened = False
+        try:
+            if conn is not None and time.time() - released > self.probe_interval \
+               and not self._is_alive(conn):
+                probe_failed = True
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._open()
+                opened = True
+        finally:
+            with self.lock:
+                self.opening -= 1
+                self.counters['probe_failures'] += probe_failed
+                self.counters['closed'] += probe_failed
+                self.counters['opened'] += opened
+                if conn is not None:
+                    self.in_use.add(conn)
+                self.lock.notify()
+
+        if warm:
+            self.prewarm()
+        return conn
+
+    def release(self, conn):
+        self._check_fork()
+        with self.lock:
+            if conn not in self.in_use:
+                # Checked out before a fork, or already released
+                return
+            self.in_use.remove(conn)
+
+            # Connections that are broken, still have cursors open or are still
+            # running a query that timed out are not reused
+            if self.closed or not conn.socket or len(conn.cursor_cache) > 0 or len(conn.timed_out) > 0:
+                self.counters['closed'] += 1
+                self._discard(conn)
+            else:
+                self.idle.append((conn, time.time()))
+            self._reap()
+            self.lock.notify()
+
+    # Opens connections until the pool holds `min_size` of them
+    def prewarm(self):
+        self._check_fork()
+        while True:
+            with self.lock:
+                if self.closed or len(self.idle) + len(self.in_use) + self.opening >= self.min_size:
+                    return
+                self.opening += 1
+            conn = None
+            try:
+                conn = self._open()
+            finally:
+                with self.lock:
+                    self.opening -= 1
+                    if conn is not None:
+                        self.counters['opened'] += 1
+                        self.idle.insert(0, (conn, time.time()))
+                    self.lock.notify()
+
+    # Closes connections that have been idle for too long. Must hold the lock.
+    def _reap(self):
+        now = time.time()
+        excess = len(self.idle) + len(self.in_use) - self.min_size
+        while excess > 0 and len(self.idle) > 0 and now - self.idle[0][1] > self.max_idle:
+            (conn, released) = self.idle.pop(0)
+            self.counters['closed'] += 1
+            self._discard(conn)
+            excess -= 1
+
+    def reap(self):
+        self._check_fork()
+        with self.lock:
+            self._reap()
+
+    def connection(self, timeout=()):
+        return _PooledConnection(self, timeout)
+
+    def stats(self):
+        self._check_fork()
+        with self.lock:
+            stats = dict(self.counters)
+            stats['idle'] = len(self.idle)
+            stats['in_use'] = len(self.in_use)
+            if self.single_flight is not None:
+                stats['deduplicated'] = self.single_flight.stats()['deduplicated']
+            return stats
+
+    def close(self, noreply_wait=True):
+        self._check_fork()
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, [ ]
+            self.counters['closed'] += len(idle)
+            self.lock.notify_all()
+        for (conn, released) in idle:
+            conn.close(noreply_wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close(noreply_wait=False)
+
+class _PooledConnection(object):
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.timeout = timeout
+        self.conn = None
+
+    def __enter__(self):
+        self.conn = self.pool.acquire(self.timeout)
+        return self.conn
+
+    def __exit__(self, type, value, traceback):
+        self.pool.release(self.conn)
+        self.conn = None
+
+# The wire format shared by the blocking and asynchronous connections. Every
+# message is a protobuf preceded by its length as a little-endian uint32.
+
+def _handshake(auth_key):
+    return struct.pack("<L", p.VersionDummy.V0_2) + \
+           struct.pack("<L", len(auth_key)) + str.encode(auth_key, 'ascii')
+
+def _frame_query(query):
+    query.accepts_r_json = True
+    query_protobuf = query.SerializeToString()
+    return struct.pack("<L", len(query_protobuf)) + query_protobuf
+
+def _parse_response(response_buf):
+    global _parses_views
+    if _parses_views is None:
+        _parses_views = _check_parses_views()
+    if not _parses_views and isinstance(response_buf, memoryview):
+        response_buf = response_buf.tobytes()
+    response = protobuf().Response()
+    response.ParseFromString(response_buf)
+    return response
+
+# Older protobuf implementations only parse strings, in which case frames
+# have to be copied out of the receive buffer before they can be parsed
+def _check_parses_views():
+    pb = protobuf()
+    response = pb.Response()
+    response.type = p.Response.SUCCESS_ATOM
+    response.token = 1
+    datum = response.response.add()
+    datum.type = p.Datum.R_STR
+    datum.r_str = u'view'
+    try:
+        parsed = pb.Response()
+        parsed.ParseFromString(memoryview(bytearray(response.SerializeToString())))
+        return parsed == response
+    except Exception:
+        return False
+
+_parses_views = None # Checked when the first response is parsed
+
+# A reusable receive buffer that splits the response stream into frames. Data
+# is received straight into the buffer in large chunks and every complete
+# frame is returned as a view into it, so a response is never copied before
+# being parsed. A view is only valid until more data is received.
+class _ResponseBuffer(object):
+    default_size = 64 * 1024
+
+    def __init__(self, size=default_size):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0 # Start of the data not yet returned as a frame
+        self.end = 0   # End of the data received so far
+
+    def empty(self):
+        return self.start == self.end
+
+    def next_frame(self):
+        available = self.end - self.start
+        if available < 4:
+            return None
+
+        # The first 4 bytes give the expected length of this response
+        (response_len,) = struct.unpack_from("<L", self.buf, self.start)
+        if available < 4 + response_len:
+            return None
+
+        frame = self.view[self.start + 4:self.start + 4 + response_len]
+        self.start += 4 + response_len
+        return frame
+
+    # The size of the frame at the front of the buffer, if it is known yet
+    def _frame_size(self):
+        if self.end - self.start < 4:
+            return 4
+        return 4 + struct.unpack_from("<L", self.buf, self.start)[0]
+
+    # Returns a view of the space data should be received into, making sure
+    # that the whole of the frame being received fits in the buffer
+    def free_space(self):
+        pending = self.end - self.start
+        needed = self._frame_size()
+
+        if pending == 0 and len(self.buf) > self.default_size:
+            # Give back the memory used by an exceptionally large response
+            self._resize(self.default_size)
+        elif needed > len(self.buf):
+            self._resize(needed)
+        elif self.start > 0 and needed > len(self.buf) - self.start:
+            self._compact()
+        return self.view[self.end:]
+
+    def received(self, length):
+        self.end += length
+
+    # Appends data that was received elsewhere (e.g. by an event loop)
+    def feed(self, data):
+        length = len(data)
+        if length > len(self.buf) - self.end:
+            pending = self.end - self.start
+            if pending + length <= len(self.buf):
+                self._compact()
+            else:
+                self._resize(max(self.default_size, pending + length, self._frame_size()))
+        self.view[self.end:self.end + length] = data
+        self.end += length
+
+    # Moves the partial frame to the front to make room for the rest
+    def _compact(self):
+        pending = self.end - self.start
+        self.buf[0:pending] = self.buf[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def _resize(self, size):
+        pending = self.end - self.start
+        buf = bytearray(size)
+        buf[0:pending] = self.view[self.start:self.end]
+        self.buf = buf
+        self.view = memoryview(buf)
+        self.start, self.end = 0, pending
+
+def connect(host='localhost', port=28015, db=None, auth_key="", timeout=20, multiplex=False, cache=None,
+            single_flight=False):
+    if multiplex:
+        return MultiplexedConnection(host, port, db, auth_key, timeout, cache,
+                                     _SingleFlight() if single_flight else None)
+    if single_flight:
+        raise RqlDriverError("Single-flight deduplication requires a multiplexed connection.")
+    return Connection(host, port, db, auth_key, timeout, cache)
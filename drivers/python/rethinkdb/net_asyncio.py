@@ -0,0 +1,385 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# A connection for trollius, the asyncio port to Python 2. Queries run on an
+# `AsyncConnection` return futures instead of blocking, so any number of
+# coroutines can keep queries in flight on a single socket; responses are
+# routed back by token.
+#
+#     conn = yield From(r.net_asyncio.connect_async(port=28015))
+#     doc = yield From(r.table('users').get(1).run(conn))
+#     cursor = yield From(r.table('users').run(conn))
+#     while True:
+#         try:
+#             doc = yield From(cursor.__anext__())
+#         except StopAsyncIteration:
+#             break
+#
+# The driver only runs on Python 2, so Python 3's asyncio is not supported.
+#
+# The `timeout` and `deadline` run options fail the query's future with an
+# `RqlTimeoutError`; they do not apply to the later batches of a cursor.
+
+__all__ = ['connect_async', 'AsyncConnection', 'AsyncCursor']
+
+import collections
+import socket
+import time
+
+import trollius as asyncio
+
+from rethinkdb import ql2 as p
+
+from rethinkdb.errors import *
+from rethinkdb.ast import expr
+from rethinkdb.wire import protobuf
+from rethinkdb.stats import QueryEvent
+from rethinkdb.net import Connection, Cursor, _ResponseBuffer, _handshake, _parse_response, _new_counters
+
+# Python 2 has no asynchronous iteration protocol
+class StopAsyncIteration(Exception):
+    pass
+
+def _resolved(loop, value):
+    future = asyncio.Future(loop=loop)
+    future.set_result(value)
+    return future
+
+class AsyncCursor(Cursor):
+    def __init__(self, conn, query, term, opts):
+        Cursor.__init__(self, conn, query, term, opts)
+        # Batches are decoded on the event loop as they are consumed
+        self.decode_ahead = False
+        self.rows = collections.deque()
+        self.waiter = None
+
+    def _extend(self, response):
+        Cursor._extend(self, response)
+        self._advance()
+
+    def _abort(self, err):
+        self.end_flag = True
+        self.responses = [ ]
+        self.buffered_bytes = 0
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_exception(err)
+        self.waiter = None
+
+    # Reading the cursor in a blocking way (iterating it, `next_batch`,
+    # `to_columns`) would have to wait on the event loop it runs on
+    def __iter__(self):
+        raise RqlDriverError("An AsyncCursor cannot be iterated synchronously, read it with `yield From(cursor.__anext__())`.")
+
+    def _peek_response(self):
+        raise RqlDriverError("An AsyncCursor cannot be read synchronously, read it with `yield From(cursor.__anext__())`.")
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        if self.waiter is not None and not self.waiter.done():
+            raise RqlDriverError("Cursor is already being read by another coroutine.")
+        self.waiter = asyncio.Future(loop=self.conn._loop)
+        waiter = self.waiter
+        self._advance()
+        return waiter
+
+    # Resolves the pending `__anext__` future if a row is available, asking
+    # the server for the next batch whenever the local buffer runs dry
+    def _advance(self):
+        waiter = self.waiter
+        if waiter is None or waiter.done():
+            return
+
+        while len(self.rows) == 0:
+            if len(self.responses) == 0:
+                if self.end_flag:
+                    self.waiter = None
+                    waiter.set_exception(StopAsyncIteration())
+                else:
+                    self._fetch_ahead()
+                return
+
+            response = self._pop_response()
+            self._fetch_ahead()
+            try:
+                self.conn._check_error_response(response, self.term)
+                if response.type != p.Response.SUCCESS_PARTIAL and response.type != p.Response.SUCCESS_SEQUENCE:
+                    raise RqlDriverError("Unexpected response type received for cursor")
+            except Exception as err:
+                self.waiter = None
+                waiter.set_exception(err)
+                return
+
+            self.rows.extend(self._decode_response(response))
+
+        self.waiter = None
+        waiter.set_result(self.rows.popleft())
+
+    def close(self):
+        Cursor.close(self)
+        self.rows.clear()
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_exception(StopAsyncIteration())
+        self.waiter = None
+
+class _ResponseProtocol(asyncio.Protocol):
+    def __init__(self, conn):
+        self.conn = conn
+        self.transport = None
+        self.buf = b''
+        self.recv_buffer = _ResponseBuffer()
+        self.handshake = asyncio.Future(loop=conn._loop)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(_handshake(self.conn.auth_key))
+
+    def data_received(self, data):
+        if not self.handshake.done():
+            # The server replies to the handshake with a null-terminated string
+            self.buf += data
+            end = self.buf.find(b"\0")
+            if end < 0:
+                return
+            response, data = self.buf[:end], self.buf[end + 1:]
+            self.buf = b''
+            if response != b"SUCCESS":
+                self.handshake.set_exception(RqlDriverError("Server dropped connection with message: \"%s\"" % response.strip()))
+                self.transport.close()
+                return
+            self.handshake.set_result(None)
+
+        self.recv_buffer.feed(data)
+        while True:
+            frame = self.recv_buffer.next_frame()
+            if frame is None:
+                break
+            self.conn.counters['bytes_in'] += 4 + len(frame)
+            self.conn._dispatch(_parse_response(frame))
+
+    def connection_lost(self, exc):
+        if not self.handshake.done():
+            self.handshake.set_exception(RqlDriverError("Connection is closed."))
+        self.conn._connection_lost(self.transport)
+
+class AsyncConnection(Connection):
+    _cursor_class = AsyncCursor
+
+    def __init__(self, host, port, db, auth_key, timeout, loop=None):
+        self.socket = None
+        self.transport = None
+        self.host = host
+        self.next_token = 1
+        self.db = db
+        self.auth_key = auth_key
+        self.timeout = timeout
+        self.cursor_cache = { }
+        self.abandoned = { }
+        self.timed_out = set()
+        self.counters = _new_counters()
+        self.futures = { }
+        self._loop = loop or asyncio.get_event_loop()
+
+        # Try to convert the port to an integer
+        try:
+          self.port = int(port)
+        except ValueError as err:
+          raise RqlDriverError("Could not convert port %s to an integer." % port)
+
+    def __aenter__(self):
+        return _resolved(self._loop, self)
+
+    def __aexit__(self, type, value, traceback):
+        return self.close(noreply_wait=False)
+
+    def reconnect(self, noreply_wait=True):
+        result = asyncio.Future(loop=self._loop)
+
+        def closed(future):
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                self._open(result)
+
+        self.close(noreply_wait).add_done_callback(closed)
+        return result
+
+    def _open(self, result):
+        protocol = _ResponseProtocol(self)
+        connecting = asyncio.ensure_future(
+            self._loop.create_connection(lambda: protocol, self.host, self.port),
+            loop=self._loop)
+
+        def fail(err):
+            if not result.done():
+                result.set_exception(RqlDriverError("Could not connect to %s:%s. Error: %s" % (self.host, self.port, err)))
+
+        def timed_out():
+            connecting.cancel()
+            if protocol.transport is not None:
+                protocol.transport.close()
+            fail(socket.timeout("timed out"))
+
+        timer = self._loop.call_later(self.timeout, timed_out)
+
+        def connected(future):
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                timer.cancel()
+                fail(future.exception())
+                return
+            protocol.handshake.add_done_callback(handshake_done)
+
+        def handshake_done(future):
+            timer.cancel()
+            if result.done():
+                return
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+                return
+
+            # Connection is now initialized
+            self.transport = protocol.transport
+            result.set_result(self)
+
+        connecting.add_done_callback(connected)
+
+    def close(self, noreply_wait=True):
+        result = asyncio.Future(loop=self._loop)
+
+        if self.transport is None:
+            self.cursor_cache = { }
+            result.set_result(None)
+        elif noreply_wait:
+            def waited(future):
+                self._shutdown()
+                if future.exception() is not None:
+                    result.set_exception(future.exception())
+                else:
+                    result.set_result(None)
+            self.noreply_wait().add_done_callback(waited)
+        else:
+            self._shutdown()
+            result.set_result(None)
+
+        return result
+
+    def _shutdown(self):
+        transport = self.transport
+        if transport is not None:
+            self.transport = None
+            transport.close()
+        self._fail_pending(RqlDriverError("Connection is closed."))
+
+    def _connection_lost(self, transport):
+        if transport is not None and transport is self.transport:
+            self.transport = None
+            self._fail_pending(RqlDriverError("Connection is closed."))
+
+    def _fail_pending(self, err):
+        futures, self.futures = self.futures, { }
+        for (future, query, term, opts, sent) in futures.values():
+            if not future.done():
+                future.set_exception(err)
+
+        cursors, self.cursor_cache = self.cursor_cache, { }
+        for cursor in cursors.values():
+            cursor._abort(err)
+        self.abandoned = { }
+        self.timed_out = set()
+
+    # Routes a response to the future or cursor waiting on its token
+    def _dispatch(self, response):
+        token = response.token
+        if token in self.futures:
+            (future, query, term, opts, sent) = self.futures.pop(token)
+            self._received(query, response, sent)
+            if future.cancelled():
+                return
+            try:
+                value = self._response_value(query, response, term, opts)
+            except Exception as err:
+                future.set_exception(err)
+            else:
+                event = getattr(query, 'event', None)
+                if event is not None:
+                    self._decoded(event, value, opts)
+                future.set_result(value)
+        elif token in self.cursor_cache:
+            self._handle_cursor_response(response)
+        elif token in self.abandoned:
+            self._drop_abandoned(response)
+        else:
+            # This response is corrupted or not intended for us.
+            self._fail_pending(RqlDriverError("Unexpected response received."))
+            self._shutdown()
+
+    # Queries sent back to back are pipelined by the transport anyway, so this
+    # just gathers their futures
+    def run_many(self, queries, **global_opt_args):
+        return asyncio.gather(*[self._start(expr(term), **dict(global_opt_args)) for term in queries])
+
+    # Observers are notified once the query's future is done
+    def _start_traced(self, term, opts):
+        event = QueryEvent(term)
+        try:
+            query = self._start_query(term, opts, event)
+            future = self._run_start(query, term, opts)
+        except Exception as err:
+            event.error = err
+            self._notify(event)
+            raise
+
+        def done(future):
+            if future.cancelled():
+                event.error = asyncio.CancelledError()
+            else:
+                event.error = future.exception()
+            self._notify(event)
+        future.add_done_callback(done)
+        return future
+
+    def _in_flight(self):
+        return len(self.futures) + Connection._in_flight(self)
+
+    def _continue_cursor(self, cursor):
+        self._async_continue_cursor(cursor)
+
+    def _read_response(self, token):
+        raise RqlDriverError("Responses are read by the event loop on an AsyncConnection.")
+
+    def _sock_sendall(self, data):
+        self.transport.write(data)
+
+    def _send_query(self, query, term, opts={}, async=False):
+        # Error if this connection has closed
+        if self.transport is None:
+            raise RqlDriverError("Connection is closed.")
+
+        self._send_frames([query])
+
+        if 'noreply' in opts and opts['noreply']:
+            return _resolved(self._loop, None)
+        elif async:
+            return None
+
+        future = asyncio.Future(loop=self._loop)
+        self.futures[query.token] = (future, query, term, opts, time.time())
+        if opts.get('deadline') is not None:
+            self._loop.call_later(max(opts['deadline'] - time.time(), 0), self._time_out, query.token, future)
+        return future
+
+    def _time_out(self, token, future):
+        entry = self.futures.get(token)
+        if entry is None or entry[0] is not future:
+            # Answered in time
+            return
+        del self.futures[token]
+        if self.transport is not None:
+            self._abandon(token, 1)
+        if not future.done():
+            future.set_exception(RqlTimeoutError("Query timed out."))
+
+def connect_async(host='localhost', port=28015, db=None, auth_key="", timeout=20, loop=None):
+    return AsyncConnection(host, port, db, auth_key, timeout, loop).reconnect(noreply_wait=False)
@@ -0,0 +1,144 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Prepared queries. A query is compiled to protobuf once, with holes where its
+# parameters go; running it only serializes the bound parameter values and
+# splices them in.
+#
+#     get_user = r.prepare(lambda id: r.table('users').get(id))
+#     get_user(1).run(conn)
+#
+#     by_age = r.prepare(r.table('users').filter(r.row['age'] > r.param('age')))
+#     by_age.bind(age=30).run(conn)
+
+__all__ = ['PreparedQuery', 'BoundQuery']
+
+from rethinkdb.errors import *
+from rethinkdb.ast import RqlQuery, Datum, Param, expr
+from rethinkdb.wire import encode_term, varint, varint_field, delimited_tag, protobuf
+
+_query_term_tag = delimited_tag(2)   # Query.query
+_term_args_tag = delimited_tag(3)    # Term.args
+_term_optargs_tag = delimited_tag(4) # Term.optargs
+_pair_key_tag = delimited_tag(1)     # AssocPair.key
+_pair_val_tag = delimited_tag(2)     # AssocPair.val
+
+def _delimited(tag, body):
+    if isinstance(body, str):
+        return tag + varint(len(body)) + body
+    return (tag, body)
+
+# Compiles a term into a template: a string if it contains no parameters, or
+# otherwise a list of strings and `(tag, body)` pairs, where the body is the
+# template of a length delimited field or a `Param`. Also collects the names
+# of the parameters in the order they appear.
+def _compile(node, params):
+    if isinstance(node, Param):
+        if node.name not in params:
+            params.append(node.name)
+        return node
+    if isinstance(node, Datum):
+        return encode_term(node)
+
+    parts = [varint_field(1, node.tt)]
+    for arg in node.args:
+        parts.append(_delimited(_term_args_tag, _compile(arg, params)))
+    for (key, value) in node.optargs.items():
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        pair = _join([_delimited(_pair_key_tag, key), _delimited(_pair_val_tag, _compile(value, params))])
+        parts.append(_delimited(_term_optargs_tag, pair))
+    return _join(parts)
+
+# Merges adjacent strings, returning a single string if nothing else is left
+def _join(parts):
+    joined = [ ]
+    for part in parts:
+        if isinstance(part, str) and len(joined) > 0 and isinstance(joined[-1], str):
+            joined[-1] += part
+        else:
+            joined.append(part)
+    if len(joined) == 1 and isinstance(joined[0], str):
+        return joined[0]
+    return joined
+
+def _render(parts, values):
+    data = [ ]
+    for part in parts:
+        if isinstance(part, str):
+            data.append(part)
+        else:
+            (tag, body) = part
+            if isinstance(body, Param):
+                body = values[body.name]
+            else:
+                body = _render(body, values)
+            data.append(tag + varint(len(body)) + body)
+    return ''.join(data)
+
+class PreparedQuery(object):
+    def __init__(self, query):
+        if isinstance(query, RqlQuery):
+            self.positional = False
+        else:
+            # The parameters of a function are named after its arguments
+            code = query.func_code
+            names = code.co_varnames[:code.co_argcount]
+            query = query(*[Param(name) for name in names])
+            self.positional = True
+
+        self.query = expr(query)
+        self.params = [ ]
+        self.template = [_delimited(_query_term_tag, _compile(self.query, self.params))]
+
+    def __call__(self, *args, **params):
+        return self.bind(*args, **params)
+
+    def __str__(self):
+        return str(self.query)
+
+    def __repr__(self):
+        return "<PreparedQuery instance: %s >" % str(self)
+
+    def bind(self, *args, **params):
+        if len(args) > 0:
+            if not self.positional:
+                raise RqlDriverError("Parameters given with r.param must be bound by name.")
+            if len(args) > len(self.params):
+                raise RqlDriverError("Expected %d parameters but got %d." % (len(self.params), len(args)))
+            for (name, value) in zip(self.params, args):
+                if name in params:
+                    raise RqlDriverError("Parameter `%s` given more than once." % name)
+                params[name] = value
+
+        values = { }
+        for name in self.params:
+            if name not in params:
+                raise RqlDriverError("Missing value for parameter `%s`." % name)
+            values[name] = encode_term(expr(params.pop(name)))
+        if len(params) > 0:
+            raise RqlDriverError("Unknown parameter `%s`." % sorted(params.keys())[0])
+        return BoundQuery(self, values)
+
+# A prepared query with values for all of its parameters. Errors are reported
+# against the prepared query, with its parameters left as placeholders.
+class BoundQuery(RqlQuery):
+    __slots__ = ('prepared', 'values')
+
+    def __init__(self, prepared, values):
+        self.prepared = prepared
+        self.values = values
+        self.args = prepared.query.args
+        self.optargs = prepared.query.optargs
+        self.has_implicit_var = prepared.query.has_implicit_var
+
+    def compose(self, args, optargs):
+        return self.prepared.query.compose(args, optargs)
+
+    # The serialized `Query.query` field
+    def serialize(self):
+        return _render(self.prepared.template, self.values)
+
+    def build(self, term):
+        query = protobuf().Query()
+        query.MergeFromString(self.serialize())
+        term.CopyFrom(query.query)
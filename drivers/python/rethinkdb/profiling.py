@@ -0,0 +1,204 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Analysis of the profiles returned for queries run with `profile=True`:
+#
+#     from rethinkdb import profiling
+#
+#     result = r.table('users').filter(r.row['age'] > 30).count().run(conn, profile=True)
+#     tree = profiling.analyze(result)
+#     print profiling.flame_summary(tree)
+#     for row in profiling.by_term(tree)[:5]:
+#         print row
+#
+# The server reports a query as a list of tasks, each either
+#  - a task with a description (e.g. "Evaluating filter."), its duration and
+#    its sub-tasks,
+#  - a split into parallel tasks (e.g. one per shard), each a list of tasks,
+#  - or a sample of many short tasks, with their mean duration and number.
+# `analyze` turns that into a tree of `ProfileNode`s, with every split as a
+# "parallel" node whose children are its branches. A node's `total` is the
+# wall clock time it took and its `self_time` the part of it not spent in its
+# children. The branches of a split run at the same time, so a split lasts as
+# long as its slowest branch, and it has no time of its own; the `work` of a
+# node adds up the time of all its branches instead.
+#
+# All times are in milliseconds. See `_profile.py` for a command line tool
+# that analyzes profiles saved as JSON.
+
+__all__ = ['ProfileNode', 'analyze', 'by_term', 'parallel_tasks', 'flame_summary', 'folded_stacks',
+           'diff', 'format_diff']
+
+from rethinkdb.errors import *
+
+class ProfileNode(object):
+    def __init__(self, kind, description, total=0.0, samples=None):
+        self.kind = kind # 'query', 'task', 'parallel', 'branch' or 'sample'
+        self.description = description
+        self.total = total
+        self.samples = samples
+        self.children = [ ]
+
+    @property
+    def self_time(self):
+        if self.kind == 'parallel':
+            return 0.0
+        return max(self.total - sum(child.total for child in self.children), 0.0)
+
+    @property
+    def work(self):
+        if len(self.children) == 0:
+            return self.total
+        return self.self_time + sum(child.work for child in self.children)
+
+    # Yields (path, node) for this node and every node below it, where the
+    # path is the tuple of the node's ancestors
+    def walk(self, path=()):
+        yield (path, self)
+        path = path + (self,)
+        for child in self.children:
+            for item in child.walk(path):
+                yield item
+
+    def __repr__(self):
+        return "<ProfileNode %s %r total=%.3fms>" % (self.kind, self.description, self.total)
+
+def _tasks(tasks):
+    nodes = [ ]
+    for task in tasks:
+        if not isinstance(task, dict):
+            raise RqlDriverError("Malformed profile: expected an object, got %r." % (task,))
+        if 'parallel_tasks' in task:
+            branches = task['parallel_tasks']
+            node = ProfileNode('parallel', "Parallel tasks (%d)" % len(branches))
+            for (i, branch) in enumerate(branches):
+                child = ProfileNode('branch', "Task %d of %d" % (i + 1, len(branches)))
+                child.children = _tasks(branch)
+                child.total = sum(grandchild.total for grandchild in child.children)
+                node.children.append(child)
+            node.total = max([child.total for child in node.children] + [0.0])
+        elif 'mean_duration(ms)' in task:
+            samples = task.get('n_samples', 1)
+            node = ProfileNode('sample', task.get('description', ''),
+                               task['mean_duration(ms)'] * samples, samples)
+        else:
+            node = ProfileNode('task', task.get('description', ''), task.get('duration(ms)', 0.0))
+            node.children = _tasks(task.get('sub_tasks', [ ]))
+        nodes.append(node)
+    return nodes
+
+# Builds the tree of a profile. Takes the profile itself or the result of a
+# query run with `profile=True`.
+def analyze(profile):
+    if isinstance(profile, ProfileNode):
+        return profile
+    if isinstance(profile, dict) and 'profile' in profile:
+        profile = profile['profile']
+    if not isinstance(profile, list):
+        raise RqlDriverError("Malformed profile: expected an array of tasks.")
+
+    root = ProfileNode('query', "Query")
+    root.children = _tasks(profile)
+    root.total = sum(child.total for child in root.children)
+    return root
+
+# Time by task description, most expensive first: how often the task ran,
+# the time spent in the task itself (`self_time`, summed over parallel
+# branches) and the wall clock time of its outermost occurrences (`total`)
+def by_term(profile):
+    terms = { }
+    for (path, node) in analyze(profile).walk():
+        if node.kind not in ('task', 'sample'):
+            continue
+        row = terms.get(node.description)
+        if row is None:
+            row = terms[node.description] = {'description': node.description, 'count': 0,
+                                             'self_time': 0.0, 'total': 0.0}
+        row['count'] += node.samples if node.samples is not None else 1
+        row['self_time'] += node.self_time
+        if all(parent.description != node.description for parent in path):
+            row['total'] += node.total
+    return sorted(terms.values(), key=lambda row: row['self_time'], reverse=True)
+
+# How the work of every split was shared out between its branches. An
+# `imbalance` of 1 means every branch took as long as the slowest one.
+def parallel_tasks(profile):
+    splits = [ ]
+    for (path, node) in analyze(profile).walk():
+        if node.kind != 'parallel' or len(node.children) == 0:
+            continue
+        times = [child.total for child in node.children]
+        mean = sum(times) / len(times)
+        splits.append({'path': [parent.description for parent in path], 'branches': len(times), 'wall': node.total,
+                       'work': sum(times), 'min': min(times), 'max': max(times), 'mean': mean,
+                       'imbalance': node.total / mean if mean > 0 else 1.0})
+    return splits
+
+# The tree as indented text, with the share of the query's time each node
+# took and a bar of that length. Nodes below `min_percent` are left out.
+def flame_summary(profile, width=40, min_percent=0.5):
+    root = analyze(profile)
+    lines = [ ]
+
+    def show(node, depth):
+        share = node.total / root.total if root.total > 0 else 0.0
+        if depth > 0 and share * 100 < min_percent:
+            return
+        bar = '#' * int(round(share * width))
+        detail = ''
+        if node.kind == 'sample':
+            detail = ' [%d samples]' % node.samples
+        elif node.kind == 'parallel':
+            detail = ' [work %.3fms]' % node.work
+        lines.append("%6.1f%% %10.3fms %10.3fms  %-*s %s%s%s" %
+                     (share * 100, node.total, node.self_time, width, bar, '  ' * depth, node.description, detail))
+        for child in node.children:
+            show(child, depth + 1)
+
+    lines.append("%7s %12s %12s  %-*s %s" % ('share', 'total', 'self', width, '', 'task'))
+    show(root, 0)
+    return '\n'.join(lines)
+
+# The folded stacks of the profile, as read by flamegraph tools
+# (e.g. `flamegraph.pl`): one line per stack, with the self time of its
+# last frame in microseconds. The branches of a split are merged and all
+# their time is counted, so the graph shows the work done rather than the
+# wall clock time.
+def folded_stacks(profile):
+    counts = { }
+    for (path, node) in analyze(profile).walk():
+        micros = int(round(node.self_time * 1000))
+        if micros == 0:
+            continue
+        frames = [frame.description.replace(';', ',') for frame in path + (node,) if frame.kind != 'branch']
+        stack = ';'.join(frames)
+        counts[stack] = counts.get(stack, 0) + micros
+    return ''.join("%s %d\n" % item for item in sorted(counts.items()))
+
+# Compares the time by task of two profiles of the same query, largest
+# change in self time first
+def diff(before, after):
+    before_terms = dict((row['description'], row) for row in by_term(before))
+    after_terms = dict((row['description'], row) for row in by_term(after))
+    empty = {'count': 0, 'self_time': 0.0, 'total': 0.0}
+
+    rows = [ ]
+    for description in set(before_terms) | set(after_terms):
+        old = before_terms.get(description, empty)
+        new = after_terms.get(description, empty)
+        rows.append({'description': description,
+                     'before_count': old['count'], 'after_count': new['count'],
+                     'before_self': old['self_time'], 'after_self': new['self_time'],
+                     'before_total': old['total'], 'after_total': new['total'],
+                     'delta': new['self_time'] - old['self_time']})
+    return sorted(rows, key=lambda row: abs(row['delta']), reverse=True)
+
+def format_diff(before, after):
+    (before, after) = (analyze(before), analyze(after))
+    lines = ["%12s %12s %12s %8s  %s" % ('before', 'after', 'delta', 'change', 'task (self time)')]
+    for row in diff(before, after):
+        change = '%+7.1f%%' % (row['delta'] / row['before_self'] * 100) if row['before_self'] > 0 else '     new'
+        lines.append("%10.3fms %10.3fms %+10.3fms %8s  %s" %
+                     (row['before_self'], row['after_self'], row['delta'], change, row['description']))
+    lines.append("%10.3fms %10.3fms %+10.3fms %8s  %s" %
+                 (before.total, after.total, after.total - before.total, '', 'Query (total)'))
+    return '\n'.join(lines)
@@ -1,5 +1,6 @@
 from .ast import *
-from . import ql2_pb2 as p
+from .prepared import PreparedQuery
+from . import ql2 as p
 import datetime
 
 """
@@ -8,6 +9,12 @@ All top level functions defined here are the starting points for RQL queries
 def json(json_str):
     return Json(json_str)
 
+def param(name):
+    return Param(name)
+
+def prepare(query):
+    return PreparedQuery(query)
+
 def js(js_str, timeout=()):
     return JavaScript(js_str, timeout=timeout)
 
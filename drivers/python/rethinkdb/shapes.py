@@ -0,0 +1,279 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Query shapes: a query with its literal values replaced by placeholders, so
+# that queries that only differ in their values share a shape and a
+# fingerprint:
+#
+#     shape = r.QueryShape(r.table('users').get(1))
+#     shape.text          # "r.table('users').get(?)"
+#     shape.fingerprint   # the same for every `r.table('users').get(...)`
+#
+# Table, database, field and index names are kept, as are optional arguments
+# (e.g. `index='email'`); lambda variables are numbered in the order they
+# appear; and the keys of a `get_all` become a single placeholder, so that
+# lookups of any number of keys share a shape.
+#
+# Two observers (see stats.py) build on them:
+#  - `ShapeStats` counts queries and keeps a latency histogram per shape, for
+#    up to `max_shapes` shapes. Once it is full, the tenth of its shapes that
+#    took the least time are dropped together to make room for new ones.
+#    `top(5)` gives the shapes that cost the most, with their share of the
+#    time of all queries.
+#  - `SlowQueryLog` keeps the last `max_entries` queries that took at least
+#    `threshold` seconds, with their shape, phase timings, response size and,
+#    for queries run with `profile=True`, the server's profile.
+#
+#     shapes = r.ShapeStats()
+#     slow = r.SlowQueryLog(threshold=0.5)
+#     pool.add_observer(shapes)
+#     pool.add_observer(slow)
+#
+# Both work out the shape of every query they are given, which walks the
+# whole query, so they cost more than the observers of stats.py.
+
+__all__ = ['QueryShape', 'ShapeStats', 'SlowQueryLog']
+
+import collections
+import hashlib
+import heapq
+import threading
+
+from rethinkdb import ql2 as p
+
+from rethinkdb.errors import *
+from rethinkdb.ast import Datum, JsonData, MakeArray, MakeObj, Var, Func
+from rethinkdb.prepared import BoundQuery
+from rethinkdb.stats import Histogram
+
+# Terms whose literal arguments, from the given position on, are names of
+# tables, fields or indexes rather than values
+_name_args = {
+    p.Term.DB: 0,
+    p.Term.TABLE: 0,
+    p.Term.DB_CREATE: 0,
+    p.Term.DB_DROP: 0,
+    p.Term.TABLE_CREATE: 0,
+    p.Term.TABLE_DROP: 0,
+    p.Term.INDEX_CREATE: 0,
+    p.Term.INDEX_DROP: 0,
+    p.Term.INDEX_STATUS: 0,
+    p.Term.INDEX_WAIT: 0,
+    p.Term.ASC: 0,
+    p.Term.DESC: 0,
+    p.Term.GET_FIELD: 1,
+    p.Term.HAS_FIELDS: 1,
+    p.Term.WITH_FIELDS: 1,
+    p.Term.PLUCK: 1,
+    p.Term.WITHOUT: 1,
+    p.Term.ORDERBY: 1,
+    p.Term.GROUPBY: 1,
+    p.Term.EQ_JOIN: 1
+}
+
+def _is_literal(node):
+    node_type = type(node)
+    if node_type is Datum or node_type is JsonData:
+        return True
+    if node_type is MakeArray or node_type is MakeObj:
+        return all(_is_literal(arg) for arg in node.args) and \
+               all(_is_literal(arg) for arg in node.optargs.values())
+    return False
+
+# Works out which nodes of a query are printed as placeholders, along with a
+# canonical form of the query's shape that the fingerprint is taken from
+class _Normalizer(object):
+    def __init__(self):
+        self.placeholders = set() # Ids of the literal nodes
+        self.collapsed = set()    # Ids of the `get_all` terms whose keys are all literal
+        self.var_numbers = { }    # Variable id -> number in order of appearance
+
+    def _var(self, var_id):
+        number = self.var_numbers.get(var_id)
+        if number is None:
+            number = self.var_numbers[var_id] = len(self.var_numbers) + 1
+        return number
+
+    def walk(self, node, names=False):
+        if _is_literal(node):
+            if names:
+                return QueryPrinter(node).print_query()
+            self.placeholders.add(id(node))
+            return '?'
+
+        node_type = type(node)
+        if node_type is Var:
+            return 'var_%d' % self._var(node.args[0].data)
+        if node_type is Func:
+            numbers = ['var_%d' % self._var(arg.data) for arg in node.args[0].args]
+            return 'lambda %s: %s' % (', '.join(numbers), self.walk(node.args[1]))
+
+        tt = getattr(node, 'tt', None)
+        if tt is None:
+            # e.g. `r.param`, which is part of the shape
+            return QueryPrinter(node).print_query()
+
+        args = node.args
+        first_name = _name_args.get(tt)
+        if tt == p.Term.GET_ALL and len(args) > 1 and all(_is_literal(arg) for arg in args[1:]):
+            self.collapsed.add(id(node))
+            parts = [self.walk(args[0]), '?...']
+        else:
+            parts = [self.walk(arg, first_name is not None and i >= first_name) for (i, arg) in enumerate(args)]
+
+        # The optional arguments of other terms are options, the fields of an
+        # object are values
+        option = node_type is not MakeObj
+        for key in sorted(node.optargs.keys()):
+            parts.append('%s=%s' % (key, self.walk(node.optargs[key], option)))
+        return '%d(%s)' % (tt, ', '.join(parts))
+
+class _ShapePrinter(QueryPrinter):
+    def __init__(self, root, normalizer):
+        QueryPrinter.__init__(self, root)
+        self.normalizer = normalizer
+
+    def compose_term(self, term):
+        normalizer = self.normalizer
+        if id(term) in normalizer.placeholders:
+            return '?'
+        if type(term) is Var:
+            return 'var_%d' % normalizer.var_numbers[term.args[0].data]
+        if type(term) is Func:
+            numbers = ['var_%d' % normalizer.var_numbers[arg.data] for arg in term.args[0].args]
+            return T('lambda ', T(*numbers, intsp=', '), ': ', self.compose_term(term.args[1]))
+
+        if id(term) in normalizer.collapsed:
+            args = [self.compose_term(term.args[0]), '?...']
+        else:
+            args = [self.compose_term(a) for a in term.args]
+        optargs = {}
+        for name in term.optargs.keys():
+            optargs[name] = self.compose_term(term.optargs[name])
+        return term.compose(args, optargs)
+
+class QueryShape(object):
+    def __init__(self, query):
+        if isinstance(query, BoundQuery):
+            query = query.prepared.query
+        self.query = query
+        self.normalizer = _Normalizer()
+        canonical = self.normalizer.walk(query)
+        if isinstance(canonical, unicode):
+            canonical = canonical.encode('utf-8')
+        self.fingerprint = hashlib.sha1(canonical).hexdigest()[:16]
+        self._text = None
+
+    # The query as it would print, with placeholders for its values
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = _ShapePrinter(self.query, self.normalizer).print_query()
+        return self._text
+
+    def __repr__(self):
+        return "<QueryShape %s: %s>" % (self.fingerprint, self.text)
+
+class _ShapeEntry(object):
+    def __init__(self, text):
+        self.text = text
+        self.count = 0
+        self.errors = 0
+        self.time = 0.0
+        self.histogram = Histogram()
+
+class ShapeStats(object):
+    def __init__(self, max_shapes=1000):
+        if max_shapes < 1:
+            raise RqlDriverError("Invalid number of shapes: max_shapes=%s." % max_shapes)
+        self.max_shapes = max_shapes
+        self.lock = threading.Lock()
+        self.entries = { } # Fingerprint -> _ShapeEntry
+        self.count = 0
+        self.time = 0.0
+        self.evictions = 0
+
+    def __call__(self, event):
+        shape = QueryShape(event.term)
+        latency = event.total
+        with self.lock:
+            self.count += 1
+            self.time += latency
+            entry = self.entries.get(shape.fingerprint)
+            if entry is None:
+                if len(self.entries) >= self.max_shapes:
+                    self._evict()
+                entry = self.entries[shape.fingerprint] = _ShapeEntry(shape.text)
+            entry.count += 1
+            entry.time += latency
+            entry.errors += event.error is not None
+        entry.histogram.add(latency)
+
+    # Drops the cheapest shapes in one pass, so that new shapes only cost a
+    # scan of all of them every `max_shapes / 10` shapes. Must hold the lock.
+    def _evict(self):
+        count = max(self.max_shapes // 10, 1)
+        cheapest = heapq.nsmallest(count, self.entries, key=lambda fingerprint: self.entries[fingerprint].time)
+        for fingerprint in cheapest:
+            del self.entries[fingerprint]
+        self.evictions += len(cheapest)
+
+    # The `k` shapes that took the most time (or, with `by='count'`, that
+    # were run the most), with the share of the time of all queries each took
+    def top(self, k=5, by='time'):
+        if by not in ('time', 'count'):
+            raise RqlDriverError("Cannot order shapes by %s." % by)
+        with self.lock:
+            entries = sorted(self.entries.items(), key=lambda item: getattr(item[1], by), reverse=True)[:k]
+            total = self.time
+
+        top = [ ]
+        for (fingerprint, entry) in entries:
+            summary = entry.histogram.summary()
+            top.append({'fingerprint': fingerprint, 'shape': entry.text, 'count': entry.count,
+                        'errors': entry.errors, 'time': entry.time,
+                        'share': entry.time / total if total > 0 else 0.0,
+                        'mean': summary.get('mean'), 'p50': summary.get('p50'), 'p99': summary.get('p99')})
+        return top
+
+    def stats(self):
+        with self.lock:
+            return {'queries': self.count, 'time': self.time, 'shapes': len(self.entries),
+                    'evictions': self.evictions}
+
+    def clear(self):
+        with self.lock:
+            self.entries = { }
+            self.count = 0
+            self.time = 0.0
+            self.evictions = 0
+
+class SlowQueryLog(object):
+    def __init__(self, threshold=0.1, max_entries=1000, callback=None):
+        self.threshold = threshold
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.records = collections.deque(maxlen=max_entries)
+
+    def __call__(self, event):
+        latency = event.total
+        if latency < self.threshold:
+            return
+
+        shape = QueryShape(event.term)
+        record = {'time': event.started, 'fingerprint': shape.fingerprint, 'shape': shape.text,
+                  'latency': latency, 'phases': event.phases, 'bytes_in': event.bytes_in,
+                  'profile': event.profile,
+                  'error': str(event.error) if event.error is not None else None}
+        with self.lock:
+            self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    # The slow queries logged so far, oldest first
+    def entries(self):
+        with self.lock:
+            return list(self.records)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
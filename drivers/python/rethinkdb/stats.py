@@ -0,0 +1,180 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Instrumentation of the queries run on a connection. Observers added with
+# `conn.add_observer(callback)` (or `pool.add_observer`, for every connection
+# of a pool) are called with a `QueryEvent` for each query started with
+# `run()`, once its first response has been decoded or it has failed:
+#
+#     timings = r.PhaseHistograms()
+#     conn.add_observer(timings)
+#     ...
+#     timings.summary()   # {'wait': {'count': ..., 'p50': ..., 'p99': ...}, ...}
+#
+# The phases of a query, in seconds, are:
+#  - `build`: converting the run options to terms (the query itself is built
+#    by the caller, before `run()`),
+#  - `serialize`: writing the query in the wire format,
+#  - `send`: writing it to the socket,
+#  - `wait`: from then until its response has been read off the socket, that
+#    is the round trip plus the time the server spent on the query,
+#  - `decode`: parsing the response and converting it to Python values.
+# Phases a query did not go through (e.g. `send` and `wait` when it was
+# answered from a `ResultCache`) are None. For a cursor only the first batch
+# is timed, and its rows are converted as they are read from the cursor, after
+# the event is reported: `decode` then only covers parsing the response.
+#
+# Observers run on the thread that ran the query, so they should be quick.
+
+__all__ = ['QueryEvent', 'Histogram', 'PhaseHistograms']
+
+import math
+import threading
+import time
+
+from rethinkdb import ql2 as p
+
+phases = ('build', 'serialize', 'send', 'wait', 'decode')
+
+_response_types = dict((value, name) for (name, value) in vars(p.Response.ResponseType).items()
+                       if not name.startswith('_'))
+
+class QueryEvent(object):
+    __slots__ = ('term', 'token', 'started', 'stamps', 'bytes_out', 'bytes_in',
+                 'response_type', 'profile', 'error')
+
+    def __init__(self, term):
+        self.term = term
+        self.token = None
+        self.started = time.time()
+        self.stamps = { } # Phase -> time it ended
+        self.bytes_out = None
+        self.bytes_in = None
+        self.response_type = None
+        self.profile = None # The server's profile, for queries run with `profile=True`
+        self.error = None
+
+    def _stamp(self, phase):
+        self.stamps[phase] = time.time()
+
+    # How long each phase took, in seconds, or None if the query skipped it
+    @property
+    def phases(self):
+        durations = { }
+        last = self.started
+        for phase in phases:
+            end = self.stamps.get(phase)
+            if end is None:
+                durations[phase] = None
+            else:
+                durations[phase] = end - last
+                last = end
+        return durations
+
+    @property
+    def total(self):
+        return max([self.started] + self.stamps.values()) - self.started
+
+    def __repr__(self):
+        return "<QueryEvent token=%s response=%s total=%.6f>" % \
+               (self.token, _response_types.get(self.response_type), self.total)
+
+# A histogram of positive values (e.g. durations in seconds) in logarithmic
+# buckets, each `growth` times as wide as the one before, so that quantiles
+# are within `growth - 1` of the true value whatever the range of the values.
+# Recording a value is a dict update; nothing else is kept per value.
+class Histogram(object):
+    def __init__(self, growth=1.05, minimum=1e-6):
+        self.log_growth = math.log(growth)
+        self.minimum = minimum
+        self.lock = threading.Lock()
+        self.buckets = { } # Index -> count
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        if value <= self.minimum:
+            index = 0
+        else:
+            index = int(math.log(value / self.minimum) / self.log_growth) + 1
+        with self.lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    # The value below which the fraction `q` of the values fall, or None if
+    # there are none
+    def quantile(self, q):
+        with self.lock:
+            if self.count == 0:
+                return None
+            rank = q * self.count
+            seen = 0
+            for index in sorted(self.buckets):
+                seen += self.buckets[index]
+                if seen >= rank:
+                    break
+            (low, high) = (self.min, self.max)
+
+        if index == 0:
+            value = self.minimum
+        else:
+            # The middle of the bucket, in log space
+            value = self.minimum * math.exp((index - 0.5) * self.log_growth)
+        return min(max(value, low), high)
+
+    def summary(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {'count': self.count, 'mean': self.sum / self.count, 'min': self.min, 'max': self.max,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99)}
+
+    def clear(self):
+        with self.lock:
+            self.buckets = { }
+            self.count = 0
+            self.sum = 0.0
+            self.min = None
+            self.max = None
+
+# An observer that keeps a histogram per phase, one of the total time, and
+# ones of the sizes of queries and responses, in bytes
+class PhaseHistograms(object):
+    def __init__(self, growth=1.05):
+        self.histograms = dict((name, Histogram(growth)) for name in phases + ('total',))
+        self.histograms['bytes_out'] = Histogram(growth, minimum=1)
+        self.histograms['bytes_in'] = Histogram(growth, minimum=1)
+        self.lock = threading.Lock()
+        self.errors = 0
+
+    def __call__(self, event):
+        for (phase, duration) in event.phases.items():
+            if duration is not None:
+                self.histograms[phase].add(duration)
+        self.histograms['total'].add(event.total)
+        if event.bytes_out is not None:
+            self.histograms['bytes_out'].add(event.bytes_out)
+        if event.bytes_in is not None:
+            self.histograms['bytes_in'].add(event.bytes_in)
+        if event.error is not None:
+            with self.lock:
+                self.errors += 1
+
+    def __getitem__(self, name):
+        return self.histograms[name]
+
+    def summary(self):
+        summary = dict((name, histogram.summary()) for (name, histogram) in self.histograms.items())
+        summary['errors'] = self.errors
+        return summary
+
+    def clear(self):
+        for histogram in self.histograms.values():
+            histogram.clear()
+        with self.lock:
+            self.errors = 0
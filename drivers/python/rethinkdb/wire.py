@@ -0,0 +1,212 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Writes queries in the protobuf wire format (see ql2.proto) straight from the
+# query tree, without building a protobuf message per node first, and reads
+# the envelope of a response without parsing the rest of it.
+
+__all__ = ['StartQuery', 'encode_term', 'decode_envelope', 'protobuf', 'protobuf_implementation']
+
+import numbers
+import struct
+import types
+
+from rethinkdb import ql2 as p
+
+from rethinkdb.errors import *
+from rethinkdb.ast import RqlQuery, Datum, expr
+
+_ql2_pb2 = None
+_implementation = None
+
+# Returns the protobuf bindings, importing them the first time. That takes a
+# good part of the driver's import time, and queries are written without them,
+# so they are put off until a connection needs them. The C++ backend has to be
+# loaded first for the bindings to use it.
+def protobuf():
+    global _ql2_pb2, _implementation
+    if _ql2_pb2 is None:
+        try:
+            import rethinkdb.pbcpp
+            implementation = 'cpp'
+        except ImportError:
+            implementation = 'python'
+        from rethinkdb import ql2_pb2
+        _ql2_pb2 = ql2_pb2
+        _implementation = implementation
+    return _ql2_pb2
+
+# Returns 'cpp' or 'python', the protobuf backend the driver runs on. This
+# loads the protobuf bindings if no connection has done it yet.
+def protobuf_implementation():
+    protobuf()
+    return _implementation
+
+def varint(value):
+    data = [ ]
+    while value > 0x7f:
+        data.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    data.append(chr(value))
+    return ''.join(data)
+
+def varint_field(field, value):
+    return varint(field << 3) + varint(value)
+
+def delimited_tag(field):
+    return varint((field << 3) | 2)
+
+_query_term_tag = delimited_tag(2)       # Query.query
+_query_optargs_tag = delimited_tag(6)    # Query.global_optargs
+_term_datum_tag = delimited_tag(2)       # Term.datum
+_term_args_tag = delimited_tag(3)        # Term.args
+_term_optargs_tag = delimited_tag(4)     # Term.optargs
+_pair_key_tag = delimited_tag(1)         # AssocPair.key
+_pair_val_tag = delimited_tag(2)         # AssocPair.val
+_datum_num_tag = varint((3 << 3) | 1)    # Datum.r_num, a double
+_datum_str_tag = delimited_tag(4)        # Datum.r_str
+
+_datum_term = varint_field(1, p.Term.DATUM) + _term_datum_tag
+_null_datum = varint_field(1, p.Datum.R_NULL)
+_bool_datums = {
+    False: varint_field(1, p.Datum.R_BOOL) + varint_field(2, 0),
+    True: varint_field(1, p.Datum.R_BOOL) + varint_field(2, 1)
+}
+_num_datum = varint_field(1, p.Datum.R_NUM) + _datum_num_tag
+_str_datum = varint_field(1, p.Datum.R_STR) + _datum_str_tag
+_accepts_r_json = varint_field(5, 1)
+
+_type_fields = { }
+_generic_build = RqlQuery.build.__func__
+
+def _write_datum(buf, data):
+    if data is None:
+        datum = _null_datum
+    elif isinstance(data, bool):
+        datum = _bool_datums[data]
+    elif isinstance(data, numbers.Real):
+        datum = _num_datum + struct.pack('<d', data)
+    elif isinstance(data, types.StringTypes):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        datum = _str_datum + varint(len(data)) + data
+    else:
+        raise RqlDriverError("Cannot build a query from a %s" % type(data).__name__)
+    buf += _datum_term
+    buf += varint(len(datum))
+    buf += datum
+
+# Writes a length delimited field whose contents are written by `write`. The
+# length is only known afterwards, so it is inserted in front of them.
+def _write_delimited(buf, tag, write, value):
+    buf += tag
+    start = len(buf)
+    write(buf, value)
+    buf[start:start] = varint(len(buf) - start)
+
+def _write_pair(buf, pair):
+    (key, value) = pair
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    buf += _pair_key_tag
+    buf += varint(len(key))
+    buf += key
+    _write_delimited(buf, _pair_val_tag, _write_term, value)
+
+def _write_term(buf, node):
+    node_type = type(node)
+    if node_type is Datum:
+        _write_datum(buf, node.data)
+        return
+    if node_type.build.__func__ is not _generic_build:
+        # Nodes that build themselves in some other way
+        term = protobuf().Term()
+        node.build(term)
+        buf += term.SerializeToString()
+        return
+
+    type_field = _type_fields.get(node.tt)
+    if type_field is None:
+        type_field = _type_fields[node.tt] = varint_field(1, node.tt)
+    buf += type_field
+
+    for arg in node.args:
+        _write_delimited(buf, _term_args_tag, _write_term, arg)
+    for pair in node.optargs.items():
+        _write_delimited(buf, _term_optargs_tag, _write_pair, pair)
+
+def encode_term(node):
+    buf = bytearray()
+    _write_term(buf, node)
+    return str(buf)
+
+# A START query. It stands in for the `Query` message when the query is sent,
+# and is encoded up front so that unserializable queries fail before anything
+# is sent. Prepared queries provide their own serialized term.
+class StartQuery(object):
+    type = p.Query.START
+    observers = () # Called with the response, before it is checked for errors
+    event = None   # The `QueryEvent` of a query timed for observers (see stats.py)
+
+    def __init__(self, token, term, global_optargs):
+        self.token = token
+        self.accepts_r_json = False
+
+        buf = bytearray(varint_field(1, p.Query.START))
+        buf += varint_field(3, token)
+        self.body_start = len(buf)
+        for pair in sorted(global_optargs.items()):
+            _write_delimited(buf, _query_optargs_tag, _write_pair, pair)
+
+        if hasattr(term, 'serialize'):
+            buf += term.serialize()
+        else:
+            _write_delimited(buf, _query_term_tag, _write_term, term)
+        self.data = str(buf)
+
+    # The query without its type and token: the same for every run of the
+    # same query with the same global optargs
+    def body(self):
+        return self.data[self.body_start:]
+
+    def SerializeToString(self):
+        if self.accepts_r_json:
+            return self.data + _accepts_r_json
+        return self.data
+
+def _read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (value, pos)
+        shift += 7
+
+# Reads the type and token of a serialized `Response` without parsing it
+def decode_envelope(data):
+    response_type = None
+    token = None
+    pos = 0
+    end = len(data)
+    while pos < end and (response_type is None or token is None):
+        (key, pos) = _read_varint(data, pos)
+        field = key >> 3
+        wire_type = key & 7
+        if wire_type == 0:
+            (value, pos) = _read_varint(data, pos)
+            if field == 1:
+                response_type = value
+            elif field == 2:
+                token = value
+        elif wire_type == 2:
+            (length, pos) = _read_varint(data, pos)
+            pos += length
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise RqlDriverError("Malformed response received.")
+    return (response_type, token)
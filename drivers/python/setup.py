@@ -35,7 +35,8 @@ setup(name="rethinkdb"
           'rethinkdb-import = rethinkdb._import:main',
           'rethinkdb-dump = rethinkdb._dump:main',
           'rethinkdb-export = rethinkdb._export:main',
-          'rethinkdb-restore = rethinkdb._restore:main']}
+          'rethinkdb-restore = rethinkdb._restore:main',
+          'rethinkdb-profile = rethinkdb._profile:main']}
       ,cmdclass = {"build_ext":build_ext_genproto}
       ,ext_modules = [Extension(
           'rethinkdb/_pbcpp',
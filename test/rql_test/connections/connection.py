@@ -313,6 +313,304 @@ class TestConnection(TestWithConnection):
             "Could not convert port abc to an integer.",
             lambda: r.connect(port='abc'))
 
+    def test_run_many(self):
+        c = r.connect(port=self.port)
+        r.db('test').table_create('t1').run(c)
+        r.table('t1').insert([{'id':i} for i in xrange(0, 10)]).run(c)
+
+        results = c.run_many([r.table('t1').get(i) for i in xrange(0, 10)] + [r.expr(1)])
+        self.assertEqual(results, [{'id':i} for i in xrange(0, 10)] + [1])
+
+        results = c.run_many([r.table('t1'), r.table('t1').count()])
+        self.assertEqual(len(list(results[0])), 10)
+        self.assertEqual(results[1], 10)
+
+        # The connection is still usable after one of the queries fails
+        self.assertRaisesRegexp(
+            r.RqlRuntimeError, "Table `t2` does not exist.",
+            c.run_many, [r.expr(1), r.table('t2'), r.expr(2)])
+        self.assertEqual(r.expr(1).run(c), 1)
+
+    def test_large_response(self):
+        c = r.connect(port=self.port)
+
+        # Responses much larger than the receive buffer are read in place
+        value = r.expr('x' * 1000).do(lambda x: r.expr(range(0, 10000)).map(lambda i: x)).run(c)
+        self.assertEqual(len(value), 10000)
+        self.assertEqual(value[-1], 'x' * 1000)
+
+        # and the connection carries on with small ones afterwards
+        self.assertEqual(c.run_many([r.expr(i) for i in xrange(0, 100)]), range(0, 100))
+
+    def test_encoding(self):
+        c = r.connect(port=self.port)
+
+        # Queries are written to the wire by the driver itself
+        value = {'str':u'\u00e9\u4e2d', 'num':-3.25, 'int':10**12, 'bool':True, 'null':None, 'arr':[1, [2, []]]}
+        self.assertEqual(r.expr(value).run(c), value)
+        self.assertEqual(r.expr([3, 1, 2]).order_by(lambda x: -x).run(c), [3, 2, 1])
+        self.assertEqual(r.expr(1).run(c, db='test', profile=False), 1)
+
+        # Plain data is sent as JSON, around any queries nested in it
+        r.db('test').table_create('t1').run(c)
+        docs = [{'id':i, 'tags':['a', 'b'], 'nested':{'x':i}} for i in xrange(0, 100)]
+        docs[5]['nested']['y'] = r.expr(2) * 3
+        self.assertEqual(r.table('t1').insert(docs).run(c)['inserted'], 100)
+        self.assertEqual(r.table('t1').get(5).run(c), {'id':5, 'tags':['a', 'b'], 'nested':{'x':5, 'y':6}})
+        self.assertEqual(str(r.expr({'a':[1, r.row['b']]})), "{'a': [1, r.row['b']]}")
+
+    def test_prepare(self):
+        c = r.connect(port=self.port)
+        r.db('test').table_create('t1').run(c)
+        r.table('t1').insert([{'id':i, 'n':i % 3} for i in xrange(0, 10)]).run(c)
+
+        get = r.prepare(lambda id: r.table('t1').get(id))
+        self.assertEqual([get(i).run(c) for i in xrange(0, 3)], [{'id':i, 'n':i} for i in xrange(0, 3)])
+        self.assertEqual(c.run_many([get(i) for i in xrange(0, 10)]), [{'id':i, 'n':i % 3} for i in xrange(0, 10)])
+
+        count = r.prepare(r.table('t1').filter(lambda doc: doc['n'] == r.param('n')).count())
+        self.assertEqual(count.bind(n=1).run(c), 3)
+        self.assertEqual(count.bind(n=r.expr(1) + 1).run(c), 3)
+        self.assertRaisesRegexp(r.RqlDriverError, "Missing value for parameter `n`.", count.bind)
+
+        # Errors are reported against the prepared query
+        self.assertRaisesRegexp(
+            r.RqlRuntimeError, "r.param\\('n'\\)",
+            r.prepare(r.table('t2').get(r.param('n'))).bind(n=1).run, c)
+
+    def test_cache(self):
+        cache = r.ResultCache(max_entries=2, ttl=60)
+        c = r.connect(port=self.port, cache=cache)
+        r.db('test').table_create('t1').run(c)
+        r.table('t1').insert([{'id':i} for i in xrange(0, 5)]).run(c)
+
+        self.assertEqual(r.table('t1').get(1).run(c, cache=True), {'id':1})
+        self.assertEqual(r.table('t1').get(1).run(c, cache=True), {'id':1})
+        self.assertEqual(list(r.table('t1').get_all(1, 2).run(c, cache=True)), [{'id':1}, {'id':2}])
+        self.assertEqual(list(r.table('t1').get_all(1, 2).run(c, cache=True)), [{'id':1}, {'id':2}])
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (2, 2, 2))
+
+        # Writes through the connection drop what they may have changed
+        r.table('t1').get(1).update({'x':1}).run(c)
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(r.table('t1').get(1).run(c, cache=True), {'id':1, 'x':1})
+
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Cannot cache a query that uses r.now\\(\\).",
+            r.now().run, c, cache=True)
+
+    def test_loader(self):
+        c = r.connect(port=self.port, multiplex=True)
+        r.db('test').table_create('t1').run(c)
+        r.table('t1').insert([{'id':i, 'n':i % 3} for i in xrange(0, 10)]).run(c)
+        r.table('t1').index_create('n').run(c)
+        r.table('t1').index_wait('n').run(c)
+
+        loader = r.GetLoader(c, r.table('t1'), window=0.05)
+        results = { }
+        def load(key):
+            results[key] = loader.load(key)
+        threads = [threading.Thread(target=load, args=(i,)) for i in xrange(0, 12)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, dict([(i, {'id':i, 'n':i % 3}) for i in xrange(0, 10)] + [(10, None), (11, None)]))
+        self.assertLess(loader.stats()['batches'], 12)
+
+        by_n = r.GetLoader(c, r.table('t1'), index='n', window=0)
+        self.assertEqual(sorted(doc['id'] for doc in by_n.load(1)), [1, 4, 7])
+        self.assertEqual(by_n.load(5), [])
+
+        # A bad key fails on its own without holding up later loads
+        self.assertRaises(r.RqlDriverError, loader.load, {'id':1})
+        self.assertEqual(loader.load(2), {'id':2, 'n':2})
+
+        # True is not the same key as 1, in a batch or in the results
+        r.table('t1').insert([{'id':True}, {'id':[1, False]}]).run(c)
+        self.assertEqual(loader.load_many([1, True, 1.0, [1, False], [1, 0]]),
+                         [{'id':1, 'n':1}, {'id':True}, {'id':1, 'n':1}, {'id':[1, False]}, None])
+
+    def test_bulk_writer(self):
+        c = r.connect(port=self.port)
+        r.db('test').table_create('t1').run(c)
+
+        with r.BulkWriter(c, r.table('t1'), max_docs=10) as writer:
+            for i in xrange(0, 25):
+                writer.add({'id':i})
+        self.assertEqual(writer.stats()['batches'], 3)
+        self.assertEqual(r.table('t1').count().run(c), 25)
+
+        # Only the last version of a document is sent
+        writer = r.BulkWriter(c, r.table('t1'), upsert=True)
+        for i in xrange(0, 9):
+            writer.add({'id':i % 3, 'v':i})
+        writer.flush()
+        self.assertEqual(writer.stats()['merged'], 6)
+        self.assertEqual(r.table('t1').get(1)['v'].run(c), 7)
+
+        # Errors are reported by flush
+        writer.close()
+        writer = r.BulkWriter(c, r.table('t1'))
+        writer.add({'id':0})
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "1 documents could not be written.", writer.flush)
+
+        writer = r.BulkWriter(c, r.table('t1'), max_docs=5, noreply=True, sync_every=2)
+        writer.add_many({'id':i} for i in xrange(100, 123))
+        writer.close()
+        self.assertEqual(r.table('t1').count().run(c), 48)
+
+        # A failure to wait for noreply batches is reported as it is
+        def noreply_wait():
+            raise r.RqlDriverError("Connection is closed.")
+        writer = r.BulkWriter(c, r.table('t1'), noreply=True)
+        writer.add({'id':200})
+        c.noreply_wait = noreply_wait
+        self.assertRaisesRegexp(r.RqlDriverError, "^Connection is closed.$", writer.flush)
+        del c.noreply_wait
+
+    def test_observers(self):
+        c = r.connect(port=self.port)
+        events = [ ]
+        timings = r.PhaseHistograms()
+        c.add_observer(events.append)
+        c.add_observer(timings)
+
+        for i in xrange(0, 10):
+            r.expr(i).run(c)
+        self.assertRaises(r.RqlRuntimeError, r.error('oops').run, c)
+
+        self.assertEqual(len(events), 11)
+        self.assertEqual(events[0].response_type, r.ql2.Response.SUCCESS_ATOM)
+        self.assertTrue(all(duration >= 0 for duration in events[0].phases.values()))
+        self.assertGreater(events[0].bytes_out, 0)
+        self.assertGreater(events[0].bytes_in, 0)
+        self.assertIsInstance(events[-1].error, r.RqlRuntimeError)
+
+        summary = timings.summary()
+        self.assertEqual((summary['wait']['count'], summary['errors']), (11, 1))
+        self.assertLessEqual(summary['wait']['p50'], summary['wait']['p99'])
+
+        c.remove_observer(timings)
+        r.expr(1).run(c)
+        self.assertEqual((len(events), timings['total'].count), (12, 11))
+
+        stats = c.stats()
+        self.assertEqual(stats['queries']['START'], 12)
+        self.assertEqual((stats['open_cursors'], stats['in_flight']), (0, 0))
+        self.assertGreater(stats['bytes_in'], 0)
+        self.assertGreater(stats['rtt'], 0)
+
+    def test_query_shapes(self):
+        by_id = r.QueryShape(r.table('t1').get(1))
+        self.assertEqual(by_id.text, "r.table('t1').get(?)")
+        self.assertEqual(by_id.fingerprint, r.QueryShape(r.table('t1').get('other')).fingerprint)
+        self.assertNotEqual(by_id.fingerprint, r.QueryShape(r.table('t2').get(1)).fingerprint)
+        self.assertEqual(r.QueryShape(r.table('t1').get_all(1, 2, 3, index='n')).fingerprint,
+                         r.QueryShape(r.table('t1').get_all(4, 5, index='n')).fingerprint)
+        self.assertEqual(r.QueryShape(r.table('t1').get_all(1)).text, "r.table('t1').get_all(?...)")
+        self.assertEqual(r.QueryShape(r.table('t1').get_all(1)).fingerprint,
+                         r.QueryShape(r.table('t1').get_all(1, 2)).fingerprint)
+        self.assertEqual(r.QueryShape(r.table('t1').filter(lambda doc: doc['n'] > 1)).text,
+                         "r.table('t1').filter(lambda var_1: (var_1['n'] > r.expr(?)))")
+
+        c = r.connect(port=self.port)
+        r.db('test').table_create('t1').run(c)
+        shapes = r.ShapeStats()
+        slow = r.SlowQueryLog(threshold=0)
+        c.add_observer(shapes)
+        c.add_observer(slow)
+
+        for i in xrange(0, 5):
+            r.table('t1').get(i).run(c)
+        r.table('t1').insert({'id':1}).run(c)
+        r.table('t1').get(1).run(c, profile=True)
+
+        top = shapes.top(1, by='count')
+        self.assertEqual((top[0]['shape'], top[0]['count']), ("r.table('t1').get(?)", 6))
+        self.assertEqual(len(slow.entries()), 7)
+        self.assertEqual(slow.entries()[0]['profile'], None)
+        self.assertNotEqual(slow.entries()[-1]['profile'], None)
+
+    def test_profile_analysis(self):
+        from rethinkdb import profiling
+
+        c = r.connect(port=self.port)
+        r.db('test').table_create('t1').run(c)
+        r.table('t1').insert([{'id':i} for i in xrange(0, 100)]).run(c)
+
+        query = r.table('t1').filter(r.row['id'] > 10).count()
+        before = profiling.analyze(query.run(c, profile=True))
+        after = profiling.analyze(query.run(c, profile=True))
+        self.assertGreater(before.total, 0)
+
+        terms = profiling.by_term(before)
+        self.assertIn("Evaluating filter.", [row['description'] for row in terms])
+        self.assertAlmostEqual(sum(row['self_time'] for row in terms), before.work, places=3)
+
+        for line in profiling.folded_stacks(before).splitlines():
+            (stack, micros) = line.rsplit(' ', 1)
+            self.assertTrue(stack.startswith('Query;'))
+            self.assertGreater(int(micros), 0)
+
+        self.assertIn("Evaluating filter.", profiling.flame_summary(before, min_percent=0))
+        self.assertTrue(set(row['description'] for row in terms) <=
+                        set(row['description'] for row in profiling.diff(before, after)))
+
+    def test_query_timeout(self):
+        c = r.connect(port=self.port)
+        runaway = r.js('while(true) {}', timeout=1)
+
+        start = time()
+        self.assertRaises(r.RqlTimeoutError, runaway.run, c, timeout=0.2)
+        self.assertLess(time() - start, 0.9)
+        self.assertRaises(r.RqlTimeoutError, runaway.run, c, deadline=time() + 0.2)
+        self.assertRaises(r.RqlTimeoutError, c.run_many, [r.expr(1), runaway], timeout=0.2)
+
+        # The connection is still usable once the server is done with them
+        self.assertEqual(r.expr(1).run(c), 1)
+        self.assertEqual(r.expr(2).run(c, timeout=5), 2)
+        self.assertEqual(c.abandoned, { })
+
+        r.db('test').table_create('t1').run(c)
+        r.table('t1').insert([{'id':i} for i in xrange(0, 1000)]).run(c)
+        self.assertEqual(len(list(r.table('t1').run(c, timeout=10))), 1000)
+
+    def test_times(self):
+        c = r.connect(port=self.port)
+        times = r.expr([{'t':r.epoch_time(i).in_timezone('+02:00')} for i in xrange(0, 10)]).run(c)
+        self.assertEqual([t['t'].utcoffset().seconds for t in times], [7200] * 10)
+        self.assertTrue(times[0]['t'].tzinfo is times[9]['t'].tzinfo)
+
+        raw = r.epoch_time(1).in_timezone('+02:00').run(c, time_format='raw')
+        self.assertEqual(raw['$reql_type$'], 'TIME')
+
+        # Datetimes nested in data are sent inline as TIME objects
+        import datetime
+        ts = datetime.datetime(2014, 3, 1, 12, 30, 15, 250000, r.make_timezone('-07:30'))
+        self.assertEqual(type(r.expr([ts])), r.ast.JsonData)
+        value = r.expr({'ts':ts, 'tss':[ts, ts]}).run(c)
+        self.assertEqual(value['ts'], ts)
+        self.assertEqual(value['ts'].utcoffset(), ts.utcoffset())
+        self.assertEqual(value['tss'], [ts, ts])
+
+        # Next to a query they become terms of their own
+        value = r.expr([ts, r.epoch_time(1)]).run(c)
+        self.assertEqual(value[0], ts)
+        value = r.expr({'now':r.now(), 'ts':ts}).run(c)
+        self.assertEqual(value['ts'], ts)
+
+        # A decoder without object hook support gets a second pass instead
+        import json
+        r.set_json_decoder(json.loads, object_hook=False)
+        try:
+            self.assertEqual(r.epoch_time(1).run(c).utcoffset().seconds, 0)
+        finally:
+            r.set_json_decoder()
+
 class TestShutdown(TestWithConnection):
     def test_shutdown(self):
         c = r.connect(port=self.port)
@@ -324,6 +622,198 @@ class TestShutdown(TestWithConnection):
             r.expr(1).run, c)
 
 
+class TestConnectionPool(TestWithConnection):
+    def test_checkout(self):
+        pool = r.ConnectionPool(port=self.port, min_size=2, max_size=2)
+        self.assertEqual(pool.stats()['opened'], 0)
+
+        with pool.connection() as c:
+            self.assertEqual(r.expr(1).run(c), 1)
+        self.assertEqual(pool.stats()['opened'], 2)
+        self.assertEqual(pool.stats()['idle'], 2)
+
+        c1 = pool.acquire()
+        c2 = pool.acquire()
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Timed out waiting for a connection from the pool.",
+            pool.acquire, timeout=0.1)
+        pool.release(c1)
+        self.assertIs(pool.acquire(timeout=0.1), c1)
+        pool.release(c1)
+        pool.release(c2)
+
+        stats = pool.stats()
+        self.assertEqual(stats['checkouts'], 4)
+        self.assertEqual(stats['timeouts'], 1)
+
+        pool.close()
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Connection pool is closed.",
+            pool.acquire)
+
+    def test_threads(self):
+        pool = r.ConnectionPool(port=self.port, max_size=4)
+        results = []
+
+        def work():
+            for i in xrange(0, 50):
+                with pool.connection() as c:
+                    results.append(r.expr(i).run(c))
+
+        threads = [threading.Thread(target=work) for i in xrange(0, 10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(results), 500)
+        self.assertLessEqual(pool.stats()['opened'], 4)
+        pool.close()
+
+    def test_reap(self):
+        pool = r.ConnectionPool(port=self.port, min_size=1, max_size=3, max_idle=0)
+        conns = [pool.acquire() for i in xrange(0, 3)]
+        for c in conns:
+            pool.release(c)
+        pool.reap()
+        self.assertEqual(pool.stats()['idle'], 1)
+        pool.close()
+
+    def test_probe_timeout(self):
+        pool = r.ConnectionPool(port=self.port, max_size=1, probe_interval=0, probe_timeout=0.2)
+        c = pool.acquire()
+        # The server is busy on this connection, so the probe gets no answer
+        r.js('while(true) {}', timeout=2).run(c, noreply=True)
+        pool.release(c)
+
+        start = time()
+        c2 = pool.acquire()
+        self.assertLess(time() - start, 1)
+        self.assertIsNot(c2, c)
+        self.assertEqual(pool.stats()['probe_failures'], 1)
+        self.assertEqual(r.expr(1).run(c2), 1)
+        pool.release(c2)
+        pool.close()
+
+    def test_prefetch_release(self):
+        pool = r.ConnectionPool(port=self.port, max_size=1, probe_interval=0)
+        c = pool.acquire()
+        r.db('test').table_create('t1').run(c)
+        r.table('t1').insert([{'id':i, 'pad':'x' * 1000} for i in xrange(0, 2000)]).run(c)
+
+        # Batches requested ahead of the end of the stream are still answered
+        # after the cursor is done, without keeping the connection busy
+        self.assertEqual(len(list(r.table('t1').run(c, prefetch=4))), 2000)
+        self.assertEqual(c.cursor_cache, {})
+        self.assertEqual(c.stats()['in_flight'], 0)
+        pool.release(c)
+        self.assertIs(pool.acquire(), c)
+
+        cursor = r.table('t1').run(c, prefetch=4)
+        next(iter(cursor))
+        cursor.close()
+        self.assertEqual(c.cursor_cache, {})
+        pool.release(c)
+        self.assertIs(pool.acquire(), c)
+        self.assertEqual(r.expr(1).run(c), 1)
+        pool.release(c)
+        pool.close()
+
+class TestMultiplexedConnection(TestWithConnection):
+    def runTest(self):
+        c = r.connect(port=self.port, multiplex=True)
+        self.assertEqual(type(c), r.MultiplexedConnection)
+
+        r.db('test').table_create('t1').run(c)
+        r.table('t1').insert([{'id':i} for i in xrange(0, 2000)]).run(c)
+
+        results = []
+        errors = []
+        def work():
+            try:
+                for i in xrange(0, 20):
+                    results.append(r.expr(i).run(c))
+                results.append(len(list(r.table('t1').run(c))))
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=work) for i in xrange(0, 10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 210)
+        self.assertEqual(results.count(2000), 10)
+
+        # Identical reads in flight together share one response, but every
+        # caller gets a value of its own
+        c2 = r.connect(port=self.port, multiplex=True, single_flight=True)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(r.table('t1').get(1).run(c2)))
+                   for i in xrange(0, 10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, [{'id':1}] * 10)
+        self.assertEqual(len(set(id(value) for value in results)), 10)
+        stats = c2.single_flight.stats()
+        self.assertEqual(stats['led'] + stats['deduplicated'], 10)
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Single-flight deduplication requires a multiplexed connection.",
+            r.connect, port=self.port, single_flight=True)
+
+        c.close()
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Connection is closed.",
+            r.expr(1).run, c)
+
+class TestAsyncConnection(TestWithConnection):
+    def setUp(self):
+        try:
+            from rethinkdb import net_asyncio
+        except ImportError:
+            self.skipTest("trollius is not available")
+        self.net_asyncio = net_asyncio
+        self.loop = net_asyncio.asyncio.new_event_loop()
+        TestWithConnection.setUp(self)
+
+    def tearDown(self):
+        TestWithConnection.tearDown(self)
+        self.loop.close()
+
+    def runTest(self):
+        asyncio = self.net_asyncio.asyncio
+        c = self.loop.run_until_complete(
+            self.net_asyncio.connect_async(port=self.port, loop=self.loop))
+
+        # Many queries can be in flight on the same connection at once
+        results = self.loop.run_until_complete(
+            asyncio.gather(*[r.expr(i).run(c) for i in xrange(0, 100)]))
+        self.assertEqual(results, range(0, 100))
+
+        r.db('test').table_create('t1').run(r.connect(port=self.port))
+        r.table('t1').insert([{'id':i} for i in xrange(0, 2000)]).run(r.connect(port=self.port))
+
+        cursor = self.loop.run_until_complete(r.table('t1').run(c))
+        self.assertRaises(r.RqlDriverError, iter, cursor)
+        count = 0
+        while True:
+            try:
+                self.loop.run_until_complete(cursor.__anext__())
+                count += 1
+            except self.net_asyncio.StopAsyncIteration:
+                break
+        self.assertEqual(count, 2000)
+
+        self.loop.run_until_complete(c.close())
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Connection is closed.",
+            r.expr(1).run, c)
+
 # This doesn't really have anything to do with connections but it'll go
 # in here for the time being.
 class TestPrinting(unittest.TestCase):
@@ -334,6 +824,14 @@ class TestPrinting(unittest.TestCase):
         self.assertEqual(str(r.db('db1').table('tbl1').map(lambda x: x)),
                             "r.db('db1').table('tbl1').map(lambda var_1: var_1)")
 
+class TestCopying(unittest.TestCase):
+    def runTest(self):
+        import copy, pickle
+        for query in [r.expr(1), r.table('t1').get(1), r.expr([1, {'a':2}]), r.row['a'] > 1]:
+            for duplicate in [copy.copy(query), copy.deepcopy(query), pickle.loads(pickle.dumps(query, 2))]:
+                self.assertEqual(str(duplicate), str(query))
+                self.assertEqual(duplicate.has_implicit_var, query.has_implicit_var)
+
 class TestBatching(TestWithConnection):
     def runTest(self):
         c = r.connect(port=self.port)
@@ -385,7 +883,11 @@ if __name__ == '__main__':
     suite.addTest(loader.loadTestsFromTestCase(TestAuthConnection))
     suite.addTest(loader.loadTestsFromTestCase(TestConnection))
     suite.addTest(loader.loadTestsFromTestCase(TestShutdown))
+    suite.addTest(loader.loadTestsFromTestCase(TestConnectionPool))
+    suite.addTest(TestMultiplexedConnection())
+    suite.addTest(TestAsyncConnection())
     suite.addTest(TestPrinting())
+    suite.addTest(TestCopying())
     suite.addTest(TestBatching())
 
     res = unittest.TextTestRunner(verbosity=2).run(suite)
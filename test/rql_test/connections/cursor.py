@@ -29,6 +29,57 @@ class TestCursor(unittest.TestCase):
 
         self.assertEqual(i, num_rows)
 
+    def test_iter_batches(self):
+        i = 0
+        for batch in self.cur.iter_batches():
+            self.assertEqual(type(batch), list)
+            self.assertGreater(len(batch), 0)
+            i += len(batch)
+
+        self.assertEqual(i, num_rows)
+        self.assertEqual(self.cur.next_batch(), None)
+
+    def test_to_columns(self):
+        c = r.connect(port=port)
+        cols = r.table('test').pluck('id').run(c).to_columns()
+        self.assertEqual(list(cols.keys()), ['id'])
+        self.assertEqual(sorted(cols['id']), list(range(0, num_rows)))
+        self.assertEqual(sum(cols.nulls['id']), 0)
+
+        cols = r.table('test').run(c).to_columns(['id', 'missing'])
+        self.assertEqual(len(cols['id']), num_rows)
+        self.assertEqual(sum(cols.nulls['missing']), num_rows)
+
+        # Columns change kind as values of another kind arrive
+        from rethinkdb.columns import ColumnBuilder
+        builder = ColumnBuilder()
+        builder.add_batch([{'n': 1, 'b': True}, {'n': None, 'b': None}])
+        builder.add_batch([{'n': 2.5, 'b': 'x'}])
+        cols = builder.build()
+        self.assertEqual(list(cols['n'])[0::2], [1.0, 2.5])
+        self.assertEqual(list(cols['b']), [True, None, 'x'])
+        self.assertEqual(list(cols.nulls['n']), [False, True, False])
+
+    def test_raw_json(self):
+        import json
+        c = r.connect(port=port)
+        rows = list(r.table('test').run(c, result_format='raw_json'))
+        self.assertEqual(len(rows), num_rows)
+        self.assertEqual(sorted(json.loads(row)['id'] for row in rows), list(range(0, num_rows)))
+        self.assertEqual(json.loads(r.table('test').count().run(c, result_format='raw_json')), num_rows)
+
+    def test_prefetch(self):
+        c = r.connect(port=port)
+        tbl = r.table('test')
+        for opts in [{'prefetch':4}, {'prefetch':4, 'max_buffered_bytes':1}, {'prefetch':2, 'decode_ahead':True}]:
+            cur = tbl.run(c, **opts)
+            i = 0
+            for row in cur:
+                self.assertLessEqual(len(cur.responses) + cur.outstanding_requests, opts['prefetch'] + 1)
+                i += 1
+            self.assertEqual(i, num_rows)
+            self.assertEqual(cur.buffered_bytes, 0)
+
     def test_close(self):
         # This excercises a code path at the root of #650
         self.cur.close()